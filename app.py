@@ -1,4 +1,4 @@
-from flask import Flask, request, render_template, redirect, jsonify, session, url_for
+from flask import Flask, Response, request, render_template, redirect, jsonify, session, url_for
 from werkzeug.exceptions import BadRequest
 import secrets
 import json
@@ -7,13 +7,20 @@ from saml2 import BINDING_HTTP_POST, BINDING_HTTP_REDIRECT
 from webauthn.helpers import base64url_to_bytes, bytes_to_base64url, options_to_json
 
 from config import Config
-from database import db
+from database import db, start_cleanup_thread, DuplicateUserError
 from saml_handler import saml_handler
 from passkey_manager import passkey_manager
+from replay_cache import replay_cache
+from flow_state import flow_state_store
 
 app = Flask(__name__)
 app.config.from_object(Config)
 
+# Create indexes before serving (MongoDB TTL indexes expire replay IDs) and
+# periodically remove expired records that no TTL index covers
+db.create_indexes()
+start_cleanup_thread(db, Config.DB_CLEANUP_INTERVAL)
+
 # Store challenges temporarily (in production, use Redis or similar)
 challenges = {}
 
@@ -23,6 +30,69 @@ def index():
     """Home page"""
     return render_template('index.html')
 
+# ============================================================================
+# SAML Flow State
+# ============================================================================
+# With FLOW_STATE_BACKEND=cookie the AuthnRequest and authenticated user ride
+# in the signed session cookie; otherwise the cookie only carries a flow ID.
+
+
+def start_saml_flow(saml_request):
+    """Remember the AuthnRequest for this browser's SSO flow"""
+    if flow_state_store is None:
+        session['saml_session_id'] = secrets.token_urlsafe(32)
+        session['saml_request'] = saml_request
+    else:
+        session['saml_flow'] = flow_state_store.create(saml_request)
+
+
+def has_saml_flow():
+    """Check whether this browser is in the middle of an SSO flow"""
+    return bool(session.get('saml_flow') or session.get('saml_session_id'))
+
+
+def authenticate_saml_flow(user_id, email):
+    """Attach the authenticated user; returns False if there is no SSO flow"""
+    if flow_state_store is None:
+        if not session.get('saml_session_id') or not session.get('saml_request'):
+            return False
+        session['authenticated_user'] = {
+            'user_id': user_id,
+            'email': email
+        }
+        return True
+
+    flow_id = session.get('saml_flow')
+    state = flow_state_store.get(flow_id) if flow_id else None
+    if not state:
+        return False
+    state['user_id'] = user_id
+    state['email'] = email
+    return flow_state_store.update(flow_id, state)
+
+
+def consume_saml_flow():
+    """End the SSO flow, returning (saml_request, authenticated_user)"""
+    if flow_state_store is None:
+        if not session.get('saml_request') or not session.get('authenticated_user'):
+            return None, None
+        session.pop('saml_session_id', None)
+        return session.pop('saml_request'), session.pop('authenticated_user')
+
+    # Like the cookie mode, a flow without an authenticated user is left
+    # alone so an early request here cannot end it
+    flow_id = session.get('saml_flow')
+    state = flow_state_store.consume_authenticated(flow_id) if flow_id else None
+    if not state:
+        return None, None
+    session.pop('saml_flow', None)
+
+    authenticated_user = {
+        'user_id': state.pop('user_id'),
+        'email': state.pop('email', '')
+    }
+    return state, authenticated_user
+
 # ============================================================================
 # SAML IdP Endpoints
 # ============================================================================
@@ -32,7 +102,26 @@ def index():
 def saml_metadata():
     """SAML IdP metadata endpoint"""
     metadata = saml_handler.get_metadata()
-    return metadata, 200, {'Content-Type': 'application/xml'}
+    if metadata is None:
+        return "Error generating metadata", 500
+
+    # Serve the precompressed variant when the client accepts it; each
+    # encoding is a separate representation with its own strong ETag
+    if request.accept_encodings.quality('gzip') > 0:
+        response = Response(metadata.gzip_body, mimetype='application/xml')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(metadata.etag + '-gzip')
+    else:
+        response = Response(metadata.body, mimetype='application/xml')
+        response.set_etag(metadata.etag)
+
+    response.vary.add('Accept-Encoding')
+    response.last_modified = metadata.last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = Config.SAML_METADATA_MAX_AGE
+
+    # Answers If-None-Match / If-Modified-Since with 304 Not Modified
+    return response.make_conditional(request)
 
 
 @app.route('/saml/sso', methods=['GET', 'POST'])
@@ -54,15 +143,21 @@ def saml_sso():
         # Parse SAML authentication request
         req_info = saml_handler.idp.parse_authn_request(saml_request, binding)
 
-        # Store SAML request info in session
-        session_id = secrets.token_urlsafe(32)
-        session['saml_session_id'] = session_id
-        session['saml_request'] = {
+        # Load the SP's metadata now (lazily, for MDQ federations)
+        if not saml_handler.resolve_sp(req_info.message.issuer.text):
+            return "Unknown service provider", 400
+
+        # Reject AuthnRequests whose ID was already seen in the replay window
+        if replay_cache.check_and_add('authn_request', req_info.message.id):
+            return "Replayed SAMLRequest", 400
+
+        # Store SAML request info for the rest of the flow
+        start_saml_flow({
             'id': req_info.message.id,
             'destination': req_info.message.assertion_consumer_service_url,
             'issuer': req_info.message.issuer.text,
             'binding': binding,
-        }
+        })
 
         # Redirect to passkey authentication
         return redirect(url_for('passkey_auth'))
@@ -89,7 +184,11 @@ def generate_magic_link():
     user = db.get_user_by_email(email)
     if not user:
         user_id = secrets.token_urlsafe(16)
-        user = db.create_user(email, user_id)
+        try:
+            user = db.create_user(email, user_id)
+        except DuplicateUserError:
+            # Created by a concurrent request for the same email
+            user = db.get_user_by_email(email)
 
     # Generate magic link token
     token = secrets.token_urlsafe(32)
@@ -211,12 +310,13 @@ def passkey_register_verify():
 @app.route('/auth/passkey')
 def passkey_auth():
     """Passkey authentication page"""
-    # Check if there's a SAML session
-    saml_session_id = session.get('saml_session_id')
-    saml_request = session.get('saml_request')
+    # Embed options so the page can start WebAuthn without another round trip
+    options = passkey_manager.generate_authentication_options()
 
     return render_template('authenticate_passkey.html',
-                           has_saml_session=bool(saml_session_id))
+                           has_saml_session=has_saml_flow(),
+                           auth_options=json.loads(options_to_json(options)),
+                           challenge_ttl=Config.PASSKEY_CHALLENGE_TTL)
 
 
 @app.route('/api/passkey/auth/options', methods=['POST'])
@@ -224,47 +324,39 @@ def passkey_auth_options():
     """Generate usernameless passkey authentication options"""
     options = passkey_manager.generate_authentication_options()
 
-    # Store challenge
-    challenge = options.challenge
-    challenge_key = secrets.token_urlsafe(16)
-    challenges[challenge_key] = {
-        'challenge': challenge
-    }
-
-    response_data = json.loads(options_to_json(options))
-    response_data['challenge_key'] = challenge_key
-
-    return jsonify(response_data)
+    return jsonify(json.loads(options_to_json(options)))
 
 
 @app.route('/api/passkey/auth/verify', methods=['POST'])
 def passkey_auth_verify():
     """Verify passkey authentication"""
     data = request.json
-    challenge_key = data.get('challenge_key')
     credential = data.get('credential')
 
-    if not challenge_key or not credential:
+    if not credential:
         return jsonify({'error': 'Missing required parameters'}), 400
 
-    # Get stored challenge
-    challenge_data = challenges.pop(challenge_key, None)
-    if not challenge_data:
-        return jsonify({'error': 'Challenge not found or expired'}), 400
+    # Challenges are stateless: check the signed one from clientDataJSON
+    # here and claim it in the shared store once the assertion verifies
+    try:
+        challenge = passkey_manager.challenge_from_credential(credential)
+    except Exception:
+        return jsonify({'error': 'Invalid clientDataJSON'}), 400
 
-    challenge = challenge_data['challenge']
+    if not passkey_manager.verify_challenge(challenge):
+        return jsonify({'error': 'Challenge not found or expired'}), 400
 
     credential_raw_id = credential.get('rawId') or credential.get('id')
     if not credential_raw_id:
         return jsonify({'error': 'Credential rawId is required'}), 400
 
     try:
-        credential_id_hex = base64url_to_bytes(credential_raw_id).hex()
+        credential_id = base64url_to_bytes(credential_raw_id)
     except Exception:
         return jsonify({'error': 'Invalid credential ID format'}), 400
 
     user, matching_cred = db.get_user_and_credential_by_credential_id(
-        credential_id_hex)
+        credential_id)
     if not user or not matching_cred:
         return jsonify({'error': 'Credential not found'}), 404
 
@@ -278,20 +370,19 @@ def passkey_auth_verify():
     if not verification['verified']:
         return jsonify({'error': 'Authentication verification failed'}), 400
 
+    # Claimed only after the signature checks out, so a forged request
+    # cannot use up someone else's challenge. The claim outlives the
+    # challenge, so it cannot expire while the challenge still verifies.
+    expires_at = passkey_manager.challenge_expires_at(challenge)
+    if not db.claim_id(f"challenge:{challenge.hex()}", expires_at):
+        return jsonify({'error': 'Challenge already used'}), 400
+
     # Update signature counter
     db.update_credential_counter(
-        user_id, credential_id_hex, verification['new_sign_count'])
-
-    # Check if there's a SAML session
-    saml_session_id = session.get('saml_session_id')
-    saml_request = session.get('saml_request')
+        user_id, credential_id, verification['new_sign_count'])
 
-    if saml_session_id and saml_request:
-        # Store authenticated user in session
-        session['authenticated_user'] = {
-            'user_id': user_id,
-            'email': email
-        }
+    # Continue the SAML flow if there is one
+    if authenticate_saml_flow(user_id, email):
         return jsonify({
             'success': True,
             'redirect_url': url_for('saml_response')
@@ -308,8 +399,8 @@ def passkey_auth_verify():
 @app.route('/saml/response')
 def saml_response():
     """Generate and send SAML response after authentication"""
-    saml_request = session.get('saml_request')
-    authenticated_user = session.get('authenticated_user')
+    # Consumed up front so a flow can only ever produce one response
+    saml_request, authenticated_user = consume_saml_flow()
 
     if not saml_request or not authenticated_user:
         return "Invalid session", 400
@@ -327,11 +418,6 @@ def saml_response():
         if not saml_response_data:
             raise Exception("Failed to create SAML response")
 
-        # Clear session
-        session.pop('saml_session_id', None)
-        session.pop('saml_request', None)
-        session.pop('authenticated_user', None)
-
         # Return HTML form that auto-submits to SP
         return render_template('saml_post.html',
                                action=saml_request['destination'],
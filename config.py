@@ -6,18 +6,69 @@ load_dotenv()
 
 class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key-change-me')
+
+    # Storage backend: 'mongodb' or 'sqlite' (embedded, single node)
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mongodb')
+    SQLITE_PATH = os.getenv('SQLITE_PATH', 'saml_passkey_idp.db')
+    SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '8'))  # connections per process
     MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017/')
     DB_NAME = os.getenv('DB_NAME', 'saml_passkey_idp')
+    DB_CLEANUP_INTERVAL = 300  # how often expired records are removed (5 minutes)
 
     # WebAuthn/Passkey configuration
     RP_ID = os.getenv('RP_ID', 'localhost')
     RP_NAME = os.getenv('RP_NAME', 'SAML Passkey IdP')
     RP_EXPECTED_ORIGIN = os.getenv('BASE_URL', 'http://localhost:5000')
 
+    # Lifetime of stateless passkey authentication challenges (in seconds);
+    # a used challenge is remembered until its own expiry, independent of
+    # REPLAY_WINDOW
+    PASSKEY_CHALLENGE_TTL = 300  # 5 minutes
+
     # SAML configuration
     BASE_URL = os.getenv('BASE_URL', 'http://localhost:5000')
     SAML_IDP_ENTITY_ID = f"{BASE_URL}/saml/metadata"
     SAML_IDP_SSO_URL = f"{BASE_URL}/saml/sso"
 
+    # Service Provider metadata: comma-separated URLs, loaded from on-disk
+    # snapshots at startup and refreshed in the background
+    SP_METADATA_URLS = [url.strip() for url in os.getenv(
+        'SP_METADATA_URLS', 'http://localhost:3000/saml/metadata').split(',') if url.strip()]
+    SP_METADATA_SNAPSHOT_DIR = os.getenv('SP_METADATA_SNAPSHOT_DIR', './sp_metadata')
+    SP_METADATA_REFRESH_INTERVAL = 3600  # 1 hour
+    SP_METADATA_TIMEOUT = 10
+
+    # Lazy per-entity SP metadata for large federations: an MDQ service base
+    # URL, or a directory with one <sha1(entityID)>.xml file per entity
+    SP_MDQ_URL = os.getenv('SP_MDQ_URL', '')
+    SP_MDQ_DIR = os.getenv('SP_MDQ_DIR', '')
+    SP_MDQ_CERT = os.getenv('SP_MDQ_CERT') or None  # when set, responses must be signed by it
+    SP_MDQ_CACHE_SIZE = int(os.getenv('SP_MDQ_CACHE_SIZE', '1000'))
+    SP_MDQ_TTL = 3600  # 1 hour
+    SP_MDQ_NEGATIVE_TTL = 60  # how long an unknown entity stays unknown
+
+    # IdP metadata is generated once and served from memory
+    SAML_SIGN_METADATA = os.getenv('SAML_SIGN_METADATA', 'false').lower() == 'true'
+    SAML_METADATA_MAX_AGE = 3600  # Cache-Control max-age (1 hour)
+    SAML_METADATA_CHECK_INTERVAL = 60  # how often to check keys for changes
+    # validUntil is counted from the start of the current UTC day, so the
+    # document is regenerated (identically in every worker) once a day
+    SAML_METADATA_VALID_DAYS = 365
+
+    # Where SAML flow state lives between /saml/sso and /saml/response:
+    # 'cookie' (signed session cookie), 'memory' or 'database' (server-side)
+    FLOW_STATE_BACKEND = os.getenv('FLOW_STATE_BACKEND', 'cookie')
+    FLOW_STATE_TTL = 600  # 10 minutes
+
     # Magic link expiration (in seconds)
     MAGIC_LINK_EXPIRATION = 3600  # 1 hour
+
+    # Replay detection for AuthnRequest and issued assertion IDs
+    REPLAY_WINDOW = int(os.getenv('REPLAY_WINDOW', '300'))  # 5 minutes
+    REPLAY_EXPECTED_RPS = float(os.getenv('REPLAY_EXPECTED_RPS', '50'))
+    REPLAY_FALSE_POSITIVE_RATE = float(
+        os.getenv('REPLAY_FALSE_POSITIVE_RATE', '0.001'))
+    REPLAY_GENERATIONS = 3
+    # File shared by the workers on this host that holds the Bloom filter
+    # ring; empty keeps the filters in each process's memory
+    REPLAY_CACHE_PATH = os.getenv('REPLAY_CACHE_PATH', 'replay_cache.bin')
@@ -1,15 +1,139 @@
+from abc import ABC, abstractmethod
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 from config import Config
 import json
+import threading
+import time
 from datetime import datetime
 
 
-class Database:
-    def __init__(self):
-        self.client = MongoClient(Config.MONGODB_URI)
-        self.db = self.client[Config.DB_NAME]
+class DuplicateUserError(Exception):
+    """A user with the same email or user_id already exists"""
+
+
+class Database(ABC):
+    """Storage interface used by the IdP.
+
+    Users are returned as dicts with ``email``, ``user_id``,
+    ``passkey_credentials``, ``created_at`` and ``updated_at``; credential IDs
+    and public keys are bytes and timestamps are naive UTC datetimes.
+    """
+
+    @abstractmethod
+    def create_indexes(self):
+        """Create the indexes used by credential and session lookups"""
+
+    @abstractmethod
+    def create_user(self, email, user_id):
+        """Create a new user; raises DuplicateUserError if the email or ID is taken"""
+
+    @abstractmethod
+    def get_user_by_email(self, email):
+        """Get user by email"""
+
+    @abstractmethod
+    def get_user_by_id(self, user_id):
+        """Get user by user_id"""
+
+    @abstractmethod
+    def add_passkey_credential(self, user_id, credential):
+        """Add a passkey credential to a user"""
+
+    @abstractmethod
+    def get_user_credentials(self, user_id):
+        """Get all passkey credentials for a user"""
+
+    @abstractmethod
+    def get_user_and_credential_by_credential_id(self, credential_id):
+        """Get user and matching credential by credential ID (bytes)"""
+
+    @abstractmethod
+    def update_credential_counter(self, user_id, credential_id, new_counter):
+        """Update the signature counter for a credential"""
+
+    @abstractmethod
+    def create_session(self, session_id, user_id, saml_request, expires_at):
+        """Create a session for tracking SAML authentication flow"""
+
+    @abstractmethod
+    def get_session(self, session_id):
+        """Get a session by ID"""
+
+    @abstractmethod
+    def update_session(self, session_id, authenticated=True):
+        """Mark session as authenticated"""
+
+    @abstractmethod
+    def delete_session(self, session_id):
+        """Delete a session"""
+
+    @abstractmethod
+    def cleanup_expired_sessions(self):
+        """Remove expired sessions"""
+
+    @abstractmethod
+    def record_seen_id(self, key, expires_at):
+        """Record a message ID for replay detection"""
+
+    @abstractmethod
+    def has_seen_id(self, key):
+        """Check whether a message ID was recorded and has not expired"""
+
+    @abstractmethod
+    def claim_id(self, key, expires_at):
+        """Atomically record an ID unless it is already live; True if this call claimed it"""
+
+    @abstractmethod
+    def cleanup_expired_replay_ids(self):
+        """Remove expired replay detection records"""
+
+    def cleanup_expired(self):
+        """Remove every kind of expired record"""
+        self.cleanup_expired_sessions()
+        self.cleanup_expired_replay_ids()
+        self.cleanup_expired_flow_states()
+
+    @abstractmethod
+    def create_flow_state(self, flow_id, data, expires_at):
+        """Store encoded SAML flow state under a flow ID"""
+
+    @abstractmethod
+    def get_flow_state(self, flow_id):
+        """Get encoded flow state if it has not expired"""
+
+    @abstractmethod
+    def update_flow_state(self, flow_id, data):
+        """Replace flow state; returns False if it is missing or expired"""
+
+    @abstractmethod
+    def consume_flow_state(self, flow_id):
+        """Atomically delete and return flow state if it has not expired"""
+
+    @abstractmethod
+    def cleanup_expired_flow_states(self):
+        """Remove expired flow state"""
+
+
+class MongoDatabase(Database):
+    def __init__(self, uri=None, db_name=None):
+        self.client = MongoClient(uri or Config.MONGODB_URI)
+        self.db = self.client[db_name or Config.DB_NAME]
         self.users = self.db.users
         self.sessions = self.db.sessions
+        self.replay_ids = self.db.replay_ids
+        self.flow_states = self.db.flow_states
+
+    def create_indexes(self):
+        """Create the indexes used by credential and session lookups"""
+        self.users.create_index('user_id', unique=True)
+        self.users.create_index('email', unique=True)
+        self.users.create_index('passkey_credentials.credential_id')
+        self.sessions.create_index('session_id', unique=True)
+        self.replay_ids.create_index('key', unique=True)
+        self.replay_ids.create_index('expires_at', expireAfterSeconds=0)
+        self.flow_states.create_index('flow_id', unique=True)
+        self.flow_states.create_index('expires_at', expireAfterSeconds=0)
 
     def create_user(self, email, user_id):
         """Create a new user"""
@@ -20,7 +144,10 @@ class Database:
             'created_at': datetime.utcnow(),
             'updated_at': datetime.utcnow()
         }
-        self.users.insert_one(user)
+        try:
+            self.users.insert_one(user)
+        except DuplicateKeyError as e:
+            raise DuplicateUserError(email) from e
         return user
 
     def get_user_by_email(self, email):
@@ -47,14 +174,15 @@ class Database:
         return user.get('passkey_credentials', []) if user else []
 
     def get_user_and_credential_by_credential_id(self, credential_id):
-        """Get user and matching credential by credential ID"""
+        """Get user and matching credential by credential ID (bytes)"""
+        keys = self._credential_id_keys(credential_id)
         user = self.users.find_one(
-            {'passkey_credentials.credential_id': credential_id})
+            {'passkey_credentials.credential_id': {'$in': keys}})
         if not user:
             return None, None
 
         for credential in user.get('passkey_credentials', []):
-            if credential.get('credential_id') == credential_id:
+            if credential.get('credential_id') in keys:
                 return user, credential
 
         return None, None
@@ -64,7 +192,8 @@ class Database:
         self.users.update_one(
             {
                 'user_id': user_id,
-                'passkey_credentials.credential_id': credential_id
+                'passkey_credentials.credential_id': {
+                    '$in': self._credential_id_keys(credential_id)}
             },
             {
                 '$set': {
@@ -74,6 +203,10 @@ class Database:
             }
         )
 
+    def _credential_id_keys(self, credential_id):
+        """Binary credential ID plus its legacy hex form for unmigrated users"""
+        return [credential_id, credential_id.hex()]
+
     def create_session(self, session_id, user_id, saml_request, expires_at):
         """Create a session for tracking SAML authentication flow"""
         session = {
@@ -106,6 +239,90 @@ class Database:
         """Remove expired sessions"""
         self.sessions.delete_many({'expires_at': {'$lt': datetime.utcnow()}})
 
+    def record_seen_id(self, key, expires_at):
+        """Record a message ID for replay detection"""
+        # Acknowledged, so a check that follows is guaranteed to see it
+        self.replay_ids.update_one(
+            {'key': key}, {'$set': {'expires_at': expires_at}}, upsert=True)
+
+    def has_seen_id(self, key):
+        """Check whether a message ID was recorded and has not expired"""
+        return self.replay_ids.find_one(
+            {'key': key, 'expires_at': {'$gt': datetime.utcnow()}}) is not None
+
+    def claim_id(self, key, expires_at):
+        """Atomically record an ID unless it is already live; True if this call claimed it"""
+        try:
+            self.replay_ids.insert_one({'key': key, 'expires_at': expires_at})
+            return True
+        except DuplicateKeyError:
+            # An expired record the TTL monitor has not removed yet can be reclaimed
+            result = self.replay_ids.update_one(
+                {'key': key, 'expires_at': {'$lte': datetime.utcnow()}},
+                {'$set': {'expires_at': expires_at}})
+            return result.modified_count == 1
+
+    def cleanup_expired_replay_ids(self):
+        """Remove expired replay detection records"""
+        self.replay_ids.delete_many({'expires_at': {'$lt': datetime.utcnow()}})
+
+    def create_flow_state(self, flow_id, data, expires_at):
+        """Store encoded SAML flow state under a flow ID"""
+        self.flow_states.insert_one({
+            'flow_id': flow_id,
+            'data': data,
+            'expires_at': expires_at
+        })
+
+    def get_flow_state(self, flow_id):
+        """Get encoded flow state if it has not expired"""
+        doc = self.flow_states.find_one(
+            {'flow_id': flow_id, 'expires_at': {'$gt': datetime.utcnow()}})
+        return doc['data'] if doc else None
+
+    def update_flow_state(self, flow_id, data):
+        """Replace flow state; returns False if it is missing or expired"""
+        result = self.flow_states.update_one(
+            {'flow_id': flow_id, 'expires_at': {'$gt': datetime.utcnow()}},
+            {'$set': {'data': data}}
+        )
+        return result.matched_count == 1
+
+    def consume_flow_state(self, flow_id):
+        """Atomically delete and return flow state if it has not expired"""
+        doc = self.flow_states.find_one_and_delete(
+            {'flow_id': flow_id, 'expires_at': {'$gt': datetime.utcnow()}})
+        return doc['data'] if doc else None
+
+    def cleanup_expired_flow_states(self):
+        """Remove expired flow state"""
+        self.flow_states.delete_many({'expires_at': {'$lt': datetime.utcnow()}})
+
+
+def create_database():
+    """Create the storage backend selected by Config.STORAGE_BACKEND"""
+    if Config.STORAGE_BACKEND == 'sqlite':
+        from sqlite_database import SQLiteDatabase
+        return SQLiteDatabase(Config.SQLITE_PATH, pool_size=Config.SQLITE_POOL_SIZE)
+    if Config.STORAGE_BACKEND == 'mongodb':
+        return MongoDatabase()
+    raise ValueError(f"Unknown STORAGE_BACKEND: {Config.STORAGE_BACKEND}")
+
+
+def start_cleanup_thread(database, interval):
+    """Remove expired records every ``interval`` seconds in a daemon thread"""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                database.cleanup_expired()
+            except Exception as e:
+                print(f"Error removing expired records: {e}")
+
+    thread = threading.Thread(target=run, name='db-cleanup', daemon=True)
+    thread.start()
+    return thread
+
 
 # Global database instance
-db = Database()
+db = create_database()
@@ -0,0 +1,160 @@
+import secrets
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+from saml2 import BINDING_HTTP_POST, BINDING_HTTP_REDIRECT
+from config import Config
+from database import db
+
+FORMAT_VERSION = 1
+BINDINGS = (BINDING_HTTP_REDIRECT, BINDING_HTTP_POST)
+FIELDS = ('id', 'destination', 'issuer', 'user_id', 'email')
+
+
+def encode_flow_state(state):
+    """Pack SAML flow state as version, binding index and length-prefixed strings"""
+    out = bytearray((FORMAT_VERSION, BINDINGS.index(state['binding'])))
+    for field in FIELDS:
+        value = (state.get(field) or '').encode('utf-8')
+        out += struct.pack('>H', len(value)) + value
+    return bytes(out)
+
+
+def decode_flow_state(data):
+    """Inverse of encode_flow_state; user fields are omitted until set"""
+    if data[0] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported flow state version {data[0]}")
+    state = {'binding': BINDINGS[data[1]]}
+    offset = 2
+    for field in FIELDS:
+        (length,) = struct.unpack_from('>H', data, offset)
+        offset += 2
+        value = bytes(data[offset:offset + length]).decode('utf-8')
+        offset += length
+        if value or field not in ('user_id', 'email'):
+            state[field] = value
+    return state
+
+
+class FlowStateStore:
+    """Server-side SAML flow state keyed by a short opaque ID.
+
+    Only the flow ID travels in the session cookie; the AuthnRequest
+    details and, once known, the authenticated user are kept here until
+    ``consume`` removes them at ``/saml/response``.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    def create(self, state):
+        """Store new flow state and return its flow ID"""
+        flow_id = secrets.token_urlsafe(16)
+        self._create(flow_id, encode_flow_state(state))
+        return flow_id
+
+    def get(self, flow_id):
+        data = self._get(flow_id)
+        return decode_flow_state(data) if data else None
+
+    def update(self, flow_id, state):
+        """Replace flow state; returns False if the flow has expired"""
+        return self._update(flow_id, encode_flow_state(state))
+
+    def consume(self, flow_id):
+        """Remove and return flow state; at most one caller gets it"""
+        data = self._consume(flow_id)
+        return decode_flow_state(data) if data else None
+
+    def consume_authenticated(self, flow_id):
+        """Consume flow state only once a user is attached; earlier calls leave it"""
+        state = self.get(flow_id)
+        if not state or 'user_id' not in state:
+            return None
+        # A user is only ever added to a flow, so the consumed state still has one
+        return self.consume(flow_id)
+
+
+class MemoryFlowStateStore(FlowStateStore):
+    """Flow state held in process memory, for single-process deployments"""
+
+    SWEEP_EVERY = 256
+
+    def __init__(self, ttl):
+        super().__init__(ttl)
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.creates = 0
+
+    def _sweep(self, now):
+        """Drop expired flows; called with the lock held"""
+        expired = [k for k, (expires_at, _) in self.entries.items() if expires_at <= now]
+        for flow_id in expired:
+            del self.entries[flow_id]
+
+    def _create(self, flow_id, data):
+        now = time.monotonic()
+        with self.lock:
+            self.creates += 1
+            if self.creates % self.SWEEP_EVERY == 0:
+                self._sweep(now)
+            self.entries[flow_id] = (now + self.ttl, data)
+
+    def _get(self, flow_id):
+        with self.lock:
+            entry = self.entries.get(flow_id)
+            if entry and entry[0] > time.monotonic():
+                return entry[1]
+            return None
+
+    def _update(self, flow_id, data):
+        with self.lock:
+            entry = self.entries.get(flow_id)
+            if not entry or entry[0] <= time.monotonic():
+                return False
+            self.entries[flow_id] = (entry[0], data)
+            return True
+
+    def _consume(self, flow_id):
+        with self.lock:
+            entry = self.entries.pop(flow_id, None)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+
+class DatabaseFlowStateStore(FlowStateStore):
+    """Flow state in the configured storage backend, shared by all workers"""
+
+    def __init__(self, ttl, database):
+        super().__init__(ttl)
+        self.database = database
+
+    def _create(self, flow_id, data):
+        expires_at = datetime.utcnow() + timedelta(seconds=self.ttl)
+        self.database.create_flow_state(flow_id, data, expires_at)
+
+    def _get(self, flow_id):
+        return self.database.get_flow_state(flow_id)
+
+    def _update(self, flow_id, data):
+        return self.database.update_flow_state(flow_id, data)
+
+    def _consume(self, flow_id):
+        return self.database.consume_flow_state(flow_id)
+
+
+def create_flow_state_store():
+    """Create the store selected by Config.FLOW_STATE_BACKEND; None keeps state in the cookie"""
+    if Config.FLOW_STATE_BACKEND == 'cookie':
+        return None
+    if Config.FLOW_STATE_BACKEND == 'memory':
+        return MemoryFlowStateStore(Config.FLOW_STATE_TTL)
+    if Config.FLOW_STATE_BACKEND == 'database':
+        return DatabaseFlowStateStore(Config.FLOW_STATE_TTL, db)
+    raise ValueError(f"Unknown FLOW_STATE_BACKEND: {Config.FLOW_STATE_BACKEND}")
+
+
+# Global flow state store (None when flow state lives in the session cookie)
+flow_state_store = create_flow_state_store()
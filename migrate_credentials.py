@@ -0,0 +1,135 @@
+"""Convert hex-encoded passkey credentials to BSON binary.
+
+Runs in batches and only selects users that still have a hex
+credential_id, so it can be interrupted and re-run at any time; the
+application accepts both forms while the migration is in progress.
+
+The credential index is updated in place and never dropped, so lookups
+stay indexed while the IdP is serving. Its on-disk size only drops after
+an offline ``compact`` of the users collection, so the report compares the
+credential ID key bytes the index holds instead.
+
+Usage:
+    python migrate_credentials.py [--batch-size 500] [--samples 200]
+"""
+import argparse
+import time
+from pymongo import UpdateOne
+from database import db, MongoDatabase
+
+def credential_key_bytes():
+    """Total size of all credential IDs, i.e. the keys of the credential index"""
+    result = list(db.users.aggregate([
+        {'$unwind': '$passkey_credentials'},
+        {'$group': {'_id': None, 'bytes': {
+            '$sum': {'$binarySize': '$passkey_credentials.credential_id'}}}},
+    ]))
+    return result[0]['bytes'] if result else 0
+
+
+def legacy_lookup(credential_id):
+    """Credential lookup as done before the migration, by hex string"""
+    hex_id = credential_id.hex()
+    user = db.users.find_one({'passkey_credentials.credential_id': hex_id})
+    if user:
+        for credential in user['passkey_credentials']:
+            if credential['credential_id'] == hex_id:
+                return user, credential
+    return None, None
+
+
+def lookup_latency(credential_ids, lookup):
+    """Median credential lookup time in milliseconds"""
+    timings = []
+    for credential_id in credential_ids:
+        start = time.perf_counter()
+        lookup(credential_id)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2] if timings else 0.0
+
+
+def sample_credential_ids(samples):
+    """Pick credential IDs (as bytes) to time lookups with"""
+    credential_ids = []
+    for user in db.users.find({}, {'passkey_credentials.credential_id': 1}).limit(samples):
+        for credential in user.get('passkey_credentials', []):
+            value = credential['credential_id']
+            credential_ids.append(
+                bytes.fromhex(value) if isinstance(value, str) else value)
+    return credential_ids[:samples]
+
+
+def convert_credential(credential):
+    """Return a copy of a credential with binary ID and public key"""
+    converted = dict(credential)
+    for field in ('credential_id', 'public_key'):
+        if isinstance(converted.get(field), str):
+            converted[field] = bytes.fromhex(converted[field])
+    return converted
+
+
+def migrate(batch_size):
+    """Convert all remaining hex credentials; returns the number of users updated"""
+    query = {'passkey_credentials.credential_id': {'$type': 'string'}}
+    migrated = 0
+    last_id = None
+
+    while True:
+        batch_query = dict(query)
+        if last_id is not None:
+            batch_query['_id'] = {'$gt': last_id}
+        users = list(db.users.find(batch_query, {'passkey_credentials': 1})
+                     .sort('_id', 1).limit(batch_size))
+        if not users:
+            break
+
+        # Match on the old array so a credential pushed concurrently is not lost;
+        # such a user is simply picked up again on the next run.
+        operations = [
+            UpdateOne(
+                {'_id': user['_id'],
+                 'passkey_credentials': user['passkey_credentials']},
+                {'$set': {'passkey_credentials': [
+                    convert_credential(c) for c in user['passkey_credentials']]}}
+            )
+            for user in users
+        ]
+        result = db.users.bulk_write(operations, ordered=False)
+        migrated += result.modified_count
+        last_id = users[-1]['_id']
+        print(f"Migrated {migrated} users (last _id {last_id})")
+
+    return migrated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--samples', type=int, default=200)
+    args = parser.parse_args()
+
+    if not isinstance(db, MongoDatabase):
+        parser.exit(message="Only the MongoDB backend stores legacy hex credentials\n")
+
+    db.create_indexes()
+    credential_ids = sample_credential_ids(args.samples)
+    key_bytes_before = credential_key_bytes()
+    latency_before = lookup_latency(credential_ids, legacy_lookup)
+
+    migrated = migrate(args.batch_size)
+
+    key_bytes_after = credential_key_bytes()
+    latency_after = lookup_latency(
+        credential_ids, db.get_user_and_credential_by_credential_id)
+
+    print(f"Users migrated: {migrated}")
+    saved = (1 - key_bytes_after / key_bytes_before) * 100 if key_bytes_before else 0.0
+    print(f"credential_id index keys: {key_bytes_before} -> {key_bytes_after} bytes "
+          f"({saved:.1f}% smaller; run compact on users offline to shrink the index file)")
+    print(f"Median lookup latency: {latency_before:.3f} -> {latency_after:.3f} ms "
+          f"over {len(credential_ids)} lookups")
+
+
+if __name__ == '__main__':
+    main()
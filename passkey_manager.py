@@ -1,5 +1,9 @@
 import secrets
 import json
+import hashlib
+import hmac
+import time
+from datetime import datetime
 from webauthn import (
     generate_registration_options,
     verify_registration_response,
@@ -13,15 +17,61 @@ from webauthn.helpers.structs import (
     AuthenticatorSelectionCriteria,
     ResidentKeyRequirement,
 )
+from webauthn.helpers import base64url_to_bytes
 from webauthn.helpers.cose import COSEAlgorithmIdentifier
 from config import Config
 
 
+def credential_bytes(value):
+    """Return a stored credential field as bytes.
+
+    Credentials are stored as BSON binary; hex strings written before
+    migrate_credentials.py has run are still accepted.
+    """
+    return bytes.fromhex(value) if isinstance(value, str) else bytes(value)
+
+
 class PasskeyManager:
     def __init__(self):
         self.rp_id = Config.RP_ID
         self.rp_name = Config.RP_NAME
         self.expected_origin = Config.RP_EXPECTED_ORIGIN
+        self.challenge_ttl = Config.PASSKEY_CHALLENGE_TTL
+        self.challenge_key = hashlib.sha256(
+            b'webauthn-challenge:' + Config.SECRET_KEY.encode('utf-8')).digest()
+
+    def issue_challenge(self):
+        """Create a stateless authentication challenge.
+
+        The challenge is issued_at (8 bytes) + nonce (16 bytes) + a truncated
+        HMAC over both, so nothing is stored until it is used.
+        """
+        body = int(time.time()).to_bytes(8, 'big') + secrets.token_bytes(16)
+        mac = hmac.new(self.challenge_key, body, hashlib.sha256).digest()[:16]
+        return body + mac
+
+    def verify_challenge(self, challenge):
+        """Check that a challenge was issued by us and has not expired"""
+        if len(challenge) != 40:
+            return False
+        body, mac = challenge[:24], challenge[24:]
+        expected = hmac.new(self.challenge_key, body, hashlib.sha256).digest()[:16]
+        if not hmac.compare_digest(mac, expected):
+            return False
+        age = time.time() - int.from_bytes(body[:8], 'big')
+        return 0 <= age <= self.challenge_ttl
+
+    def challenge_expires_at(self, challenge):
+        """UTC time after which verify_challenge rejects a challenge"""
+        issued_at = int.from_bytes(challenge[:8], 'big')
+        # One second past the inclusive age check
+        return datetime.utcfromtimestamp(issued_at + self.challenge_ttl + 1)
+
+    def challenge_from_credential(self, credential):
+        """Extract the challenge the authenticator signed from clientDataJSON"""
+        client_data = json.loads(base64url_to_bytes(
+            credential['response']['clientDataJSON']))
+        return base64url_to_bytes(client_data['challenge'])
 
     def generate_registration_options(self, user_id, email, existing_credentials=None):
         """Generate options for passkey registration"""
@@ -32,7 +82,7 @@ class PasskeyManager:
             for cred in existing_credentials:
                 exclude_credentials.append(
                     PublicKeyCredentialDescriptor(
-                        id=bytes.fromhex(cred['credential_id']))
+                        id=credential_bytes(cred['credential_id']))
                 )
 
         options = generate_registration_options(
@@ -66,8 +116,8 @@ class PasskeyManager:
 
             # Return credential data to store
             return {
-                'credential_id': verification.credential_id.hex(),
-                'public_key': verification.credential_public_key.hex(),
+                'credential_id': verification.credential_id,
+                'public_key': verification.credential_public_key,
                 'sign_count': verification.sign_count,
                 'credential_type': verification.credential_type,
                 'credential_device_type': verification.credential_device_type,
@@ -86,11 +136,12 @@ class PasskeyManager:
             for cred in user_credentials:
                 allow_credentials.append(
                     PublicKeyCredentialDescriptor(
-                        id=bytes.fromhex(cred['credential_id']))
+                        id=credential_bytes(cred['credential_id']))
                 )
 
         options = generate_authentication_options(
             rp_id=self.rp_id,
+            challenge=self.issue_challenge(),
             allow_credentials=allow_credentials,
             user_verification=UserVerificationRequirement.PREFERRED,
         )
@@ -105,7 +156,7 @@ class PasskeyManager:
                 expected_challenge=challenge,
                 expected_rp_id=self.rp_id,
                 expected_origin=self.expected_origin,
-                credential_public_key=bytes.fromhex(
+                credential_public_key=credential_bytes(
                     credential_data['public_key']),
                 credential_current_sign_count=credential_data['sign_count'],
                 require_user_verification=False,
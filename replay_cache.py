@@ -0,0 +1,252 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+from config import Config
+from database import db
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process file locks, filters stay per process
+    fcntl = None
+
+HEADER = struct.Struct('<8sIIQ')
+MAGIC = b'RPLYBLM1'
+
+# Record locks are per process, so caches in one process that map the same
+# file must also share one thread lock
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _thread_lock(path):
+    if not path:
+        return threading.Lock()
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(os.path.realpath(path), threading.Lock())
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter sized for a capacity and false-positive rate"""
+
+    def __init__(self, capacity, false_positive_rate, buffer=None):
+        capacity = max(1, int(capacity))
+        self.num_bits = max(8, int(math.ceil(
+            -capacity * math.log(false_positive_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(
+            1, int(round(self.num_bits / capacity * math.log(2))))
+        self.num_bytes = (self.num_bits + 7) // 8
+        # The bits may live in a caller-provided buffer, e.g. a shared mapping
+        self.bits = buffer if buffer is not None else bytearray(self.num_bytes)
+
+    def _positions(self, key):
+        # Kirsch-Mitzenmacher double hashing from a single 128-bit digest
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+    def clear(self):
+        self.bits[:] = bytes(len(self.bits))
+
+    def fill_ratio(self):
+        """Fraction of bits currently set"""
+        set_bits = bin(int.from_bytes(self.bits, 'little')).count('1')
+        return set_bits / self.num_bits
+
+
+class ReplayCache:
+    """Time-windowed replay detector for SAML message IDs.
+
+    IDs are kept in a ring of Bloom filters, each covering
+    ``window / (generations - 1)`` seconds, so an ID is remembered for at
+    least ``window`` seconds while memory stays fixed. A negative answer is
+    definite and needs no database read; only possible hits are confirmed
+    against the exact store.
+
+    With a ``path`` the ring lives in a memory-mapped file guarded by a
+    file lock, so every worker process on the host shares it; without one
+    it is private to the process. Either way detection covers the IDs seen
+    through this ring, not other hosts.
+    """
+
+    def __init__(self, window, expected_rps, false_positive_rate,
+                 generations=3, exact_store=None, clock=time.time, path=None):
+        self.window = window
+        self.generations = max(2, generations)
+        self.span = window / (self.generations - 1)
+        self.capacity = int(math.ceil(expected_rps * self.span))
+        self.false_positive_rate = false_positive_rate
+        self.exact_store = exact_store
+        self.clock = clock
+        self.lock = _thread_lock(path)
+        self.fd = None
+
+        # Every lookup probes all generations, so split the target rate
+        filter_rate = false_positive_rate / self.generations
+        sizing = BloomFilter(self.capacity, filter_rate)
+        num_bytes = sizing.num_bytes
+        epochs_size = 8 * self.generations
+        size = HEADER.size + epochs_size + num_bytes * self.generations
+        header = HEADER.pack(MAGIC, self.generations, sizing.num_hashes, num_bytes)
+
+        if path and fcntl is not None:
+            self.buffer = self._map_file(path, size, header)
+        else:
+            self.buffer = bytearray(size)
+            self._initialize(self.buffer, header)
+
+        view = memoryview(self.buffer)
+        # Epoch of each slot, -1 while the slot is empty
+        self.epochs = view[HEADER.size:HEADER.size + epochs_size].cast('q')
+        offset = HEADER.size + epochs_size
+        self.filters = []
+        for i in range(self.generations):
+            start = offset + i * num_bytes
+            self.filters.append(BloomFilter(
+                self.capacity, filter_rate, view[start:start + num_bytes]))
+
+        # Counters are per process
+        self.checks = 0
+        self.possible_hits = 0
+        self.false_positives = 0
+        self.replays = 0
+
+    def _initialize(self, buffer, header):
+        buffer[:len(header)] = header
+        struct.pack_into(f'{self.generations}q', buffer, HEADER.size,
+                         *([-1] * self.generations))
+
+    def _map_file(self, path, size, header):
+        """Map the shared ring, (re)initializing it if its layout differs"""
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            current = os.pread(self.fd, HEADER.size, 0)
+            if os.fstat(self.fd).st_size != size or current != header:
+                # Sized for other settings or never written: start empty
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                buffer = mmap.mmap(self.fd, size)
+                self._initialize(buffer, header)
+                return buffer
+            return mmap.mmap(self.fd, size)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+
+    def _acquire(self):
+        self.lock.acquire()
+        if self.fd is not None:
+            # POSIX record locks belong to the process, so threads also
+            # need the in-process lock; they are not inherited across fork
+            fcntl.lockf(self.fd, fcntl.LOCK_EX)
+
+    def _release(self):
+        if self.fd is not None:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        self.lock.release()
+
+    def _current_filter(self):
+        """Return the filter for the current epoch, recycling a stale slot"""
+        epoch = int(self.clock() // self.span)
+        slot = epoch % self.generations
+        if self.epochs[slot] != epoch:
+            self.filters[slot].clear()
+            self.epochs[slot] = epoch
+        # Slots left over from epochs older than the ring are stale too
+        for i in range(self.generations):
+            slot_epoch = self.epochs[i]
+            if slot_epoch != -1 and epoch - slot_epoch >= self.generations:
+                self.filters[i].clear()
+                self.epochs[i] = -1
+        return self.filters[slot]
+
+    def check_and_add(self, kind, value):
+        """Record an ID and return True if it was already seen in the window"""
+        key = f"{kind}:{value}"
+        key_bytes = key.encode('utf-8')
+
+        self._acquire()
+        try:
+            current = self._current_filter()
+            possible_hit = any(key_bytes in f for f in self.filters)
+            current.add(key_bytes)
+            self.checks += 1
+            if possible_hit:
+                self.possible_hits += 1
+
+            # Without an exact store a possible hit has to be rejected
+            replay = possible_hit
+            if self.exact_store is not None:
+                # The exact store is read and written inside the critical
+                # section with acknowledged writes: every ID accepted through
+                # this ring is stored before the next check can run, so a miss
+                # on a possible hit really is a false positive. If the write
+                # fails the request fails, and the ID was never accepted.
+                if possible_hit:
+                    replay = self.exact_store.has_seen_id(key)
+                if not replay:
+                    expires_at = datetime.utcnow() + timedelta(seconds=self.window)
+                    self.exact_store.record_seen_id(key, expires_at)
+
+            if replay:
+                self.replays += 1
+            elif possible_hit:
+                self.false_positives += 1
+            return replay
+        finally:
+            self._release()
+
+    def stats(self):
+        """Report memory use and false-positive rates"""
+        self._acquire()
+        try:
+            self._current_filter()
+            num_hashes = self.filters[0].num_hashes
+            miss_probability = 1.0
+            for f in self.filters:
+                miss_probability *= 1 - f.fill_ratio() ** num_hashes
+
+            return {
+                'window_seconds': self.window,
+                'generations': self.generations,
+                'capacity_per_generation': self.capacity,
+                'bits_per_generation': self.filters[0].num_bits,
+                'hashes': num_hashes,
+                'memory_bytes': sum(len(f.bits) for f in self.filters),
+                'target_false_positive_rate': self.false_positive_rate,
+                'estimated_false_positive_rate': 1 - miss_probability,
+                'observed_false_positive_rate': (
+                    self.false_positives / self.checks if self.checks else 0.0),
+                'checks': self.checks,
+                'possible_hits': self.possible_hits,
+                'false_positives': self.false_positives,
+                'replays': self.replays,
+                'shared': self.fd is not None,
+            }
+        finally:
+            self._release()
+
+
+# Global replay cache instance
+replay_cache = ReplayCache(
+    window=Config.REPLAY_WINDOW,
+    expected_rps=Config.REPLAY_EXPECTED_RPS,
+    false_positive_rate=Config.REPLAY_FALSE_POSITIVE_RATE,
+    generations=Config.REPLAY_GENERATIONS,
+    exact_store=db,
+    path=Config.REPLAY_CACHE_PATH,
+)
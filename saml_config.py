@@ -32,11 +32,10 @@ def get_saml_config():
             'cert_file': './saml_certs/idp_cert.pem',
         }],
         'attribute_map_dir': './saml_attribute_maps',
+        # SP metadata is loaded from snapshots and refreshed in the
+        # background by sp_metadata.SPMetadataSource (see SP_METADATA_URLS)
         'metadata': {
             'local': [],
-            'remote': [{
-                'url': 'http://localhost:3000/saml/metadata'
-            }],
         },
     }
 
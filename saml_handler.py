@@ -1,14 +1,25 @@
 import os
+import copy
+import gzip
+import hashlib
 import tempfile
 import base64
 import platform
 import subprocess
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from saml2 import server, sigver
 from saml2.response import StatusError
 from saml2.saml import NAMEID_FORMAT_UNSPECIFIED, NameID
+from saml2.samlp import response_from_string
 from saml2.config import Config as Saml2Config
-from saml2.metadata import create_metadata_string
+from saml2.metadata import entity_descriptor, metadata_tostring_fix, sign_entity_descriptor
+from saml2.validate import valid_instance
+from config import Config
 from saml_config import get_saml_config
+from sp_metadata import SPMetadataSource, LazySPMetadata
+from replay_cache import replay_cache
 
 
 # ============================================================================
@@ -86,12 +97,62 @@ if platform.system() == "Windows":
     sigver.CryptoBackendXmlSec1._run_xmlsec = patched_run_xmlsec
 
 
+class MetadataDocument:
+    """Pre-rendered IdP metadata with its HTTP validators and gzip variant"""
+
+    def __init__(self, xml, version, last_modified):
+        self.body = xml.encode('utf-8')
+        self.gzip_body = gzip.compress(self.body, compresslevel=9, mtime=0)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        self.last_modified = last_modified
+        self.version = version
+
+
 class SAMLHandler:
     def __init__(self):
         self.config = Saml2Config()
         self.config.load(get_saml_config())
         self.idp = server.Server(config=self.config)
 
+        # Serve SPs from the last snapshot right away; fetch updates off-thread
+        self.sp_metadata = SPMetadataSource(
+            self.idp.metadata,
+            Config.SP_METADATA_URLS,
+            Config.SP_METADATA_SNAPSHOT_DIR,
+            Config.SP_METADATA_REFRESH_INTERVAL,
+            Config.SP_METADATA_TIMEOUT,
+        )
+        self.sp_metadata.load_snapshots()
+        self.sp_metadata.start()
+
+        # Resolve federation SPs one at a time as their requests arrive
+        self.sp_resolver = None
+        if Config.SP_MDQ_URL or Config.SP_MDQ_DIR:
+            self.sp_resolver = LazySPMetadata(
+                self.idp.metadata.attrc,
+                mdq_url=Config.SP_MDQ_URL,
+                directory=Config.SP_MDQ_DIR,
+                max_entries=Config.SP_MDQ_CACHE_SIZE,
+                ttl=Config.SP_MDQ_TTL,
+                negative_ttl=Config.SP_MDQ_NEGATIVE_TTL,
+                timeout=Config.SP_METADATA_TIMEOUT,
+                security=self.idp.metadata.security,
+                cert=Config.SP_MDQ_CERT,
+            )
+            self.sp_metadata.install('mdq', self.sp_resolver)
+
+        self.metadata = None
+        self.metadata_checked_at = 0.0
+        self.metadata_lock = threading.Lock()
+
+    def resolve_sp(self, entity_id):
+        """Make sure an SP's metadata is loaded; returns False if it is unknown"""
+        try:
+            self.idp.metadata[entity_id]
+            return True
+        except KeyError:
+            return False
+
     def parse_authn_request(self, saml_request, binding):
         """Parse incoming SAML authentication request"""
         try:
@@ -134,33 +195,84 @@ class SAMLHandler:
             else:
                 response_bytes = response
 
+            # Record issued assertion IDs; a repeat means the ID generator is broken
+            for assertion in response_from_string(response_bytes).assertion:
+                if replay_cache.check_and_add('assertion', assertion.id):
+                    raise Exception(f"Duplicate assertion ID {assertion.id}")
+
             return base64.b64encode(response_bytes).decode('utf-8')
         except Exception as e:
             print(f"Error creating SAML response: {e}")
             return None
 
     def get_metadata(self):
-        """Get IdP metadata XML"""
+        """Get IdP metadata, regenerating it only when keys change or the day rolls over"""
+        now = time.time()
+        metadata = self.metadata
+        if metadata is not None and now - self.metadata_checked_at < Config.SAML_METADATA_CHECK_INTERVAL:
+            return metadata
+
+        with self.metadata_lock:
+            metadata = self.metadata
+            version = self._metadata_version()
+            if metadata is None or metadata.version != version:
+                # Keep serving the previous document if regeneration fails
+                metadata = self._build_metadata(version) or metadata
+                self.metadata = metadata
+            self.metadata_checked_at = now
+            return metadata
+
+    def _metadata_version(self):
+        """The UTC day plus the key and certificate modification times.
+
+        Metadata depends on nothing else, so every worker built from the same
+        files on the same day produces the same bytes and validators.
+        """
+        day = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        mtimes = []
+        for path in (self.config.key_file, self.config.cert_file):
+            try:
+                mtimes.append(int(os.stat(path).st_mtime))
+            except (OSError, TypeError):
+                mtimes.append(None)
+        return (day,) + tuple(mtimes)
+
+    def _build_metadata(self, version):
+        """Generate the IdP metadata XML for a version from _metadata_version"""
         try:
-            original_xmlsec_binary = self.config.xmlsec_binary
-            self.config.xmlsec_binary = None
-
-            metadata_xml = create_metadata_string(
-                None,
-                config=self.config,
-                valid=365,
-                sign=False,
-            )
+            day = version[0]
+            last_modified = max([day] + [
+                datetime.fromtimestamp(mtime, timezone.utc) for mtime in version[1:] if mtime])
+
+            config = self.config
+            if not Config.SAML_SIGN_METADATA:
+                # Unsigned metadata does not need xmlsec; clear it on a copy
+                # rather than on the config shared with request threads
+                config = copy.copy(self.config)
+                config.xmlsec_binary = None
 
+            descriptor = entity_descriptor(config)
+            descriptor.valid_until = (day + timedelta(days=Config.SAML_METADATA_VALID_DAYS)).strftime(
+                '%Y-%m-%dT%H:%M:%SZ')
+            signed_xml = None
+            if Config.SAML_SIGN_METADATA:
+                # Derive the signature reference ID from the content instead
+                # of a random one so the signed bytes are reproducible
+                ident = 'id-' + hashlib.sha256(str(descriptor).encode('utf-8')).hexdigest()[:40]
+                descriptor, signed_xml = sign_entity_descriptor(
+                    descriptor, ident, self.idp.sec,
+                    self.config.signing_algorithm, self.config.digest_algorithm)
+
+            valid_instance(descriptor)
+            metadata_xml = metadata_tostring_fix(
+                descriptor, {'xs': 'http://www.w3.org/2001/XMLSchema'}, signed_xml)
             if isinstance(metadata_xml, bytes):
                 metadata_xml = metadata_xml.decode('utf-8')
 
-            return metadata_xml
+            return MetadataDocument(metadata_xml, version, last_modified)
         except Exception as e:
             print(f"Error generating metadata: {e}")
             return None
-        finally:
-            self.config.xmlsec_binary = original_xmlsec_binary
 
 
 # Global SAML handler instance
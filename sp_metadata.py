@@ -0,0 +1,313 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from urllib.parse import quote
+from saml2.mdstore import InMemoryMetaData
+from saml2.sigver import SignatureError
+
+MDQ_CONTENT_TYPE = 'application/samlmetadata+xml'
+
+
+class SPMetadataSource:
+    """Service Provider metadata loaded from disk and refreshed in the background.
+
+    Each metadata URL has a snapshot file in ``snapshot_dir``, so startup
+    never waits on an SP. A daemon thread re-fetches every URL with
+    conditional GETs; successfully parsed documents are swapped into the
+    live ``MetadataStore`` and written back to the snapshot.
+    """
+
+    def __init__(self, store, urls, snapshot_dir, refresh_interval, timeout):
+        self.store = store
+        self.urls = list(urls)
+        self.snapshot_dir = snapshot_dir
+        self.refresh_interval = refresh_interval
+        self.timeout = timeout
+        self.validators = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _snapshot_path(self, url):
+        name = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.snapshot_dir, f"{name}.xml")
+
+    def _parse(self, xml):
+        """Parse a metadata document, returning None if it has no usable entities"""
+        metadata = InMemoryMetaData(self.store.attrc, xml)
+        metadata.parse(xml)
+        return metadata if len(metadata) else None
+
+    def install(self, url, metadata):
+        """Atomically swap one URL's parsed metadata into the live store"""
+        with self.lock:
+            # Rebind the whole dict so request threads iterating the old one
+            # never see it change size underneath them
+            entries = dict(self.store.metadata)
+            entries[url] = metadata
+            self.store.metadata = entries
+
+    def load_snapshots(self):
+        """Load every available snapshot into the store"""
+        for url in self.urls:
+            path = self._snapshot_path(url)
+            try:
+                with open(path, 'rb') as f:
+                    xml = f.read().decode('utf-8')
+                metadata = self._parse(xml)
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                print(f"Error loading SP metadata snapshot for {url}: {e}")
+                continue
+            if not metadata:
+                continue
+
+            self.install(url, metadata)
+            # Validators only describe a snapshot that actually loaded; without
+            # them the first refresh is a full fetch rather than a stale 304
+            self.validators[url] = self._load_validators(path)
+
+    def _load_validators(self, path):
+        try:
+            with open(path + '.json') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"Error reading SP metadata validators {path}.json: {e}")
+            return {}
+
+    def _save_snapshot(self, url, xml, validators):
+        """Write a snapshot and its HTTP validators via rename"""
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = self._snapshot_path(url)
+        for target, data in ((path, xml.encode('utf-8')),
+                             (path + '.json', json.dumps(validators).encode('utf-8'))):
+            fd, tmp_path = tempfile.mkstemp(dir=self.snapshot_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, target)
+
+    def refresh(self, url):
+        """Re-fetch one URL; returns True if new metadata was installed"""
+        validators = self.validators.get(url, {})
+        req = urllib.request.Request(url)
+        if validators.get('etag'):
+            req.add_header('If-None-Match', validators['etag'])
+        if validators.get('last_modified'):
+            req.add_header('If-Modified-Since', validators['last_modified'])
+
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                xml = resp.read().decode('utf-8')
+                new_validators = {
+                    'etag': resp.headers.get('ETag'),
+                    'last_modified': resp.headers.get('Last-Modified'),
+                }
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                print(f"Error fetching SP metadata from {url}: HTTP {e.code}")
+            return False
+        except Exception as e:
+            print(f"Error fetching SP metadata from {url}: {e}")
+            return False
+
+        try:
+            metadata = self._parse(xml)
+        except Exception as e:
+            print(f"Error parsing SP metadata from {url}: {e}")
+            return False
+        if not metadata:
+            print(f"No usable entities in SP metadata from {url}")
+            return False
+
+        self.install(url, metadata)
+        self.validators[url] = new_validators
+        try:
+            self._save_snapshot(url, xml, new_validators)
+        except OSError as e:
+            print(f"Error saving SP metadata snapshot for {url}: {e}")
+        return True
+
+    def refresh_all(self):
+        for url in self.urls:
+            self.refresh(url)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.refresh_all()
+            self.stopped.wait(self.refresh_interval)
+
+    def start(self):
+        """Start refreshing in a daemon thread, beginning immediately"""
+        if self.thread is None and self.urls:
+            self.thread = threading.Thread(
+                target=self._run, name='sp-metadata-refresh', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class LazySPMetadata(InMemoryMetaData):
+    """SP metadata resolved one entity at a time, on first use.
+
+    EntityDescriptors come from a Metadata Query (MDQ) service or from a
+    directory holding one ``<sha1(entityID)>.xml`` file per entity. Resolved
+    entities are kept in a size-bounded LRU with a TTL, unknown entities are
+    remembered for ``negative_ttl`` seconds, and concurrent misses for the
+    same entity share a single fetch.
+    """
+
+    def __init__(self, attrc, mdq_url=None, directory=None, max_entries=1000,
+                 ttl=3600, negative_ttl=60, timeout=10, security=None, cert=None):
+        super().__init__(attrc, security=security)
+        if not mdq_url and not directory:
+            raise ValueError("An MDQ URL or a metadata directory is required")
+
+        self.entity = OrderedDict()
+        self.mdq_url = mdq_url.rstrip('/') if mdq_url else None
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.cert = cert
+        self.expires = {}
+        self.missing = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, *args, **kwargs):
+        # Nothing to preload; entities are resolved on demand
+        pass
+
+    # Iteration returns snapshots so concurrent resolution cannot break callers
+    def items(self):
+        with self.lock:
+            return list(self.entity.items())
+
+    def keys(self):
+        with self.lock:
+            return list(self.entity.keys())
+
+    def values(self):
+        with self.lock:
+            return list(self.entity.values())
+
+    def __getitem__(self, entity_id):
+        entity = self.resolve(entity_id)
+        if entity is None:
+            raise KeyError(entity_id)
+        return entity
+
+    def resolve(self, entity_id):
+        """Return the parsed entity, fetching it on a miss; None if unknown"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                entity = self.entity.get(entity_id)
+                if entity is not None and self.expires[entity_id] > now:
+                    self.entity.move_to_end(entity_id)
+                    self.hits += 1
+                    return entity
+                if self.missing.get(entity_id, 0) > now:
+                    return None
+
+                event = self.inflight.get(entity_id)
+                if event is None:
+                    event = self.inflight[entity_id] = threading.Event()
+                    self.misses += 1
+                    break
+            # Another thread is fetching this entity; use its result
+            event.wait(self.timeout)
+
+        entity = None
+        failed = False
+        try:
+            entity = self._fetch(entity_id)
+        except Exception as e:
+            print(f"Error resolving SP metadata for {entity_id}: {e}")
+            failed = True
+        finally:
+            with self.lock:
+                entity = self._store(entity_id, entity, failed)
+                del self.inflight[entity_id]
+            event.set()
+        return entity
+
+    def _store(self, entity_id, entity, failed):
+        """Cache a fetch result; called with the lock held"""
+        now = time.monotonic()
+        stale = self.entity.get(entity_id)
+
+        if entity is None and failed and stale is not None:
+            # Keep serving the expired copy while the source is unavailable
+            self.expires[entity_id] = now + self.negative_ttl
+            return stale
+
+        if entity is None:
+            self.entity.pop(entity_id, None)
+            self.expires.pop(entity_id, None)
+            self.missing[entity_id] = now + self.negative_ttl
+            self.missing.move_to_end(entity_id)
+            while len(self.missing) > self.max_entries:
+                self.missing.popitem(last=False)
+            return None
+
+        self.missing.pop(entity_id, None)
+        self.entity[entity_id] = entity
+        self.entity.move_to_end(entity_id)
+        self.expires[entity_id] = now + self.ttl
+        while len(self.entity) > self.max_entries:
+            evicted, _ = self.entity.popitem(last=False)
+            del self.expires[evicted]
+        return entity
+
+    def _fetch(self, entity_id):
+        """Fetch and parse one EntityDescriptor; None if the source does not know it"""
+        if self.mdq_url:
+            url = f"{self.mdq_url}/entities/{quote(entity_id, safe='')}"
+            req = urllib.request.Request(url, headers={'Accept': MDQ_CONTENT_TYPE})
+            try:
+                with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                    xml = resp.read()
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    return None
+                raise
+        else:
+            name = hashlib.sha1(entity_id.encode('utf-8')).hexdigest()
+            try:
+                with open(os.path.join(self.directory, f"{name}.xml"), 'rb') as f:
+                    xml = f.read()
+            except FileNotFoundError:
+                return None
+
+        metadata = InMemoryMetaData(self.attrc, security=self.security)
+        metadata.cert = self.cert
+        metadata.parse_and_check_signature(xml)
+        # pysaml2 accepts unsigned documents even when given a certificate
+        if self.cert and not metadata.signed():
+            raise SignatureError(f"Unsigned SP metadata for {entity_id}")
+        return metadata.entity.get(entity_id)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entity),
+                'max_entries': self.max_entries,
+                'negative_entries': len(self.missing),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
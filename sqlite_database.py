@@ -0,0 +1,397 @@
+import json
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from database import Database, DuplicateUserError
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    email TEXT NOT NULL UNIQUE,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS credentials (
+    credential_id BLOB PRIMARY KEY,
+    user_id TEXT NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+    public_key BLOB NOT NULL,
+    sign_count INTEGER NOT NULL,
+    credential_type TEXT,
+    credential_device_type TEXT,
+    credential_backed_up INTEGER,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS credentials_user_id ON credentials(user_id);
+
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    user_id TEXT,
+    saml_request TEXT,
+    created_at TEXT NOT NULL,
+    expires_at TEXT NOT NULL,
+    authenticated INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions(expires_at);
+
+CREATE TABLE IF NOT EXISTS replay_ids (
+    key TEXT PRIMARY KEY,
+    expires_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS replay_ids_expires_at ON replay_ids(expires_at);
+
+CREATE TABLE IF NOT EXISTS flow_states (
+    flow_id TEXT PRIMARY KEY,
+    data BLOB NOT NULL,
+    expires_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS flow_states_expires_at ON flow_states(expires_at);
+"""
+
+# Statements are constant strings so sqlite3's per-connection statement
+# cache prepares each one only once.
+INSERT_USER = "INSERT INTO users (user_id, email, created_at, updated_at) VALUES (?, ?, ?, ?)"
+SELECT_USER_BY_EMAIL = "SELECT user_id, email, created_at, updated_at FROM users WHERE email = ?"
+SELECT_USER_BY_ID = "SELECT user_id, email, created_at, updated_at FROM users WHERE user_id = ?"
+TOUCH_USER = "UPDATE users SET updated_at = ? WHERE user_id = ?"
+
+INSERT_CREDENTIAL = """
+INSERT INTO credentials (credential_id, user_id, public_key, sign_count, credential_type,
+                         credential_device_type, credential_backed_up, created_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+SELECT_CREDENTIALS = """
+SELECT credential_id, public_key, sign_count, credential_type,
+       credential_device_type, credential_backed_up
+FROM credentials WHERE user_id = ? ORDER BY rowid
+"""
+SELECT_CREDENTIAL_OWNER = "SELECT user_id FROM credentials WHERE credential_id = ?"
+UPDATE_SIGN_COUNT = "UPDATE credentials SET sign_count = ? WHERE user_id = ? AND credential_id = ?"
+
+INSERT_SESSION = """
+INSERT INTO sessions (session_id, user_id, saml_request, created_at, expires_at, authenticated)
+VALUES (?, ?, ?, ?, ?, 0)
+"""
+SELECT_SESSION = """
+SELECT session_id, user_id, saml_request, created_at, expires_at, authenticated
+FROM sessions WHERE session_id = ?
+"""
+UPDATE_SESSION = "UPDATE sessions SET authenticated = ? WHERE session_id = ?"
+DELETE_SESSION = "DELETE FROM sessions WHERE session_id = ?"
+DELETE_EXPIRED_SESSIONS = "DELETE FROM sessions WHERE expires_at < ?"
+
+UPSERT_REPLAY_ID = "INSERT OR REPLACE INTO replay_ids (key, expires_at) VALUES (?, ?)"
+CLAIM_REPLAY_ID = """
+INSERT INTO replay_ids (key, expires_at) VALUES (?, ?)
+ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at
+WHERE replay_ids.expires_at <= ?
+"""
+SELECT_REPLAY_ID = "SELECT 1 FROM replay_ids WHERE key = ? AND expires_at > ?"
+DELETE_EXPIRED_REPLAY_IDS = "DELETE FROM replay_ids WHERE expires_at < ?"
+
+INSERT_FLOW_STATE = "INSERT INTO flow_states (flow_id, data, expires_at) VALUES (?, ?, ?)"
+SELECT_FLOW_STATE = "SELECT data FROM flow_states WHERE flow_id = ? AND expires_at > ?"
+UPDATE_FLOW_STATE = "UPDATE flow_states SET data = ? WHERE flow_id = ? AND expires_at > ?"
+DELETE_FLOW_STATE = "DELETE FROM flow_states WHERE flow_id = ?"
+DELETE_EXPIRED_FLOW_STATES = "DELETE FROM flow_states WHERE expires_at < ?"
+
+
+def _to_db_time(value):
+    # Fixed-width ISO strings sort in chronological order
+    return value.isoformat(sep=' ', timespec='microseconds')
+
+
+def _from_db_time(value):
+    return datetime.fromisoformat(value)
+
+
+class SQLiteDatabase(Database):
+    """Embedded storage for single-node deployments.
+
+    Operations check a connection out of a pool of at most ``pool_size``
+    connections, opened on first use; the database runs in WAL mode so
+    readers never block the writer.
+    """
+
+    def __init__(self, path, pool_size=8, timeout=5.0):
+        self.path = path
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+        self.opened = 0
+        self.pool_lock = threading.Lock()
+        self.create_indexes()
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.path, timeout=self.timeout, check_same_thread=False,
+            cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA foreign_keys=ON')
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        """Check a pooled connection out for the duration of one operation"""
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self.pool_lock:
+                if self.opened < self.pool_size:
+                    self.opened += 1
+                    opening = True
+                else:
+                    opening = False
+            if opening:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self.pool_lock:
+                        self.opened -= 1
+                    raise
+            else:
+                try:
+                    conn = self.pool.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError(
+                        "Timed out waiting for a pooled SQLite connection") from None
+        try:
+            yield conn
+        finally:
+            self.pool.put(conn)
+
+    def close(self):
+        """Close every idle pooled connection"""
+        while True:
+            try:
+                conn = self.pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self.pool_lock:
+                self.opened -= 1
+
+    def create_indexes(self):
+        """Create the tables and indexes if they do not exist"""
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+
+    def _credentials(self, conn, user_id):
+        rows = conn.execute(SELECT_CREDENTIALS, (user_id,)).fetchall()
+        return [
+            {
+                'credential_id': row['credential_id'],
+                'public_key': row['public_key'],
+                'sign_count': row['sign_count'],
+                'credential_type': row['credential_type'],
+                'credential_device_type': row['credential_device_type'],
+                'credential_backed_up': (
+                    None if row['credential_backed_up'] is None
+                    else bool(row['credential_backed_up'])),
+            }
+            for row in rows
+        ]
+
+    def _user_from_row(self, conn, row):
+        return {
+            'email': row['email'],
+            'user_id': row['user_id'],
+            'passkey_credentials': self._credentials(conn, row['user_id']),
+            'created_at': _from_db_time(row['created_at']),
+            'updated_at': _from_db_time(row['updated_at']),
+        }
+
+    def create_user(self, email, user_id):
+        """Create a new user"""
+        now = datetime.utcnow()
+        try:
+            with self._connection() as conn, conn:
+                conn.execute(INSERT_USER, (user_id, email,
+                             _to_db_time(now), _to_db_time(now)))
+        except sqlite3.IntegrityError as e:
+            raise DuplicateUserError(email) from e
+        return {
+            'email': email,
+            'user_id': user_id,
+            'passkey_credentials': [],
+            'created_at': now,
+            'updated_at': now
+        }
+
+    def get_user_by_email(self, email):
+        """Get user by email"""
+        with self._connection() as conn:
+            row = conn.execute(SELECT_USER_BY_EMAIL, (email,)).fetchone()
+            return self._user_from_row(conn, row) if row else None
+
+    def get_user_by_id(self, user_id):
+        """Get user by user_id"""
+        with self._connection() as conn:
+            row = conn.execute(SELECT_USER_BY_ID, (user_id,)).fetchone()
+            return self._user_from_row(conn, row) if row else None
+
+    def add_passkey_credential(self, user_id, credential):
+        """Add a passkey credential to a user"""
+        now = _to_db_time(datetime.utcnow())
+        with self._connection() as conn, conn:
+            conn.execute(INSERT_CREDENTIAL, (
+                bytes(credential['credential_id']),
+                user_id,
+                bytes(credential['public_key']),
+                credential['sign_count'],
+                credential.get('credential_type'),
+                credential.get('credential_device_type'),
+                credential.get('credential_backed_up'),
+                now,
+            ))
+            conn.execute(TOUCH_USER, (now, user_id))
+
+    def get_user_credentials(self, user_id):
+        """Get all passkey credentials for a user"""
+        with self._connection() as conn:
+            return self._credentials(conn, user_id)
+
+    def get_user_and_credential_by_credential_id(self, credential_id):
+        """Get user and matching credential by credential ID (bytes)"""
+        with self._connection() as conn:
+            row = conn.execute(
+                SELECT_CREDENTIAL_OWNER, (bytes(credential_id),)).fetchone()
+            if not row:
+                return None, None
+            row = conn.execute(SELECT_USER_BY_ID, (row['user_id'],)).fetchone()
+            if not row:
+                return None, None
+            user = self._user_from_row(conn, row)
+
+        for credential in user['passkey_credentials']:
+            if credential['credential_id'] == credential_id:
+                return user, credential
+
+        return None, None
+
+    def update_credential_counter(self, user_id, credential_id, new_counter):
+        """Update the signature counter for a credential"""
+        with self._connection() as conn, conn:
+            conn.execute(UPDATE_SIGN_COUNT,
+                         (new_counter, user_id, bytes(credential_id)))
+            conn.execute(TOUCH_USER, (_to_db_time(datetime.utcnow()), user_id))
+
+    def create_session(self, session_id, user_id, saml_request, expires_at):
+        """Create a session for tracking SAML authentication flow"""
+        now = datetime.utcnow()
+        with self._connection() as conn, conn:
+            conn.execute(INSERT_SESSION, (
+                session_id,
+                user_id,
+                json.dumps(saml_request),
+                _to_db_time(now),
+                _to_db_time(expires_at),
+            ))
+        return {
+            'session_id': session_id,
+            'user_id': user_id,
+            'saml_request': saml_request,
+            'created_at': now,
+            'expires_at': expires_at,
+            'authenticated': False
+        }
+
+    def get_session(self, session_id):
+        """Get a session by ID"""
+        with self._connection() as conn:
+            row = conn.execute(SELECT_SESSION, (session_id,)).fetchone()
+        if not row:
+            return None
+        return {
+            'session_id': row['session_id'],
+            'user_id': row['user_id'],
+            'saml_request': json.loads(row['saml_request']),
+            'created_at': _from_db_time(row['created_at']),
+            'expires_at': _from_db_time(row['expires_at']),
+            'authenticated': bool(row['authenticated'])
+        }
+
+    def update_session(self, session_id, authenticated=True):
+        """Mark session as authenticated"""
+        with self._connection() as conn, conn:
+            conn.execute(UPDATE_SESSION, (int(authenticated), session_id))
+
+    def delete_session(self, session_id):
+        """Delete a session"""
+        with self._connection() as conn, conn:
+            conn.execute(DELETE_SESSION, (session_id,))
+
+    def cleanup_expired_sessions(self):
+        """Remove expired sessions"""
+        with self._connection() as conn, conn:
+            conn.execute(DELETE_EXPIRED_SESSIONS,
+                         (_to_db_time(datetime.utcnow()),))
+
+    def record_seen_id(self, key, expires_at):
+        """Record a message ID for replay detection"""
+        with self._connection() as conn, conn:
+            conn.execute(UPSERT_REPLAY_ID, (key, _to_db_time(expires_at)))
+
+    def has_seen_id(self, key):
+        """Check whether a message ID was recorded and has not expired"""
+        with self._connection() as conn:
+            row = conn.execute(
+                SELECT_REPLAY_ID, (key, _to_db_time(datetime.utcnow()))).fetchone()
+        return row is not None
+
+    def claim_id(self, key, expires_at):
+        """Atomically record an ID unless it is already live; True if this call claimed it"""
+        with self._connection() as conn, conn:
+            cursor = conn.execute(CLAIM_REPLAY_ID, (
+                key, _to_db_time(expires_at), _to_db_time(datetime.utcnow())))
+        return cursor.rowcount == 1
+
+    def cleanup_expired_replay_ids(self):
+        """Remove expired replay detection records"""
+        with self._connection() as conn, conn:
+            conn.execute(DELETE_EXPIRED_REPLAY_IDS,
+                         (_to_db_time(datetime.utcnow()),))
+
+    def create_flow_state(self, flow_id, data, expires_at):
+        """Store encoded SAML flow state under a flow ID"""
+        with self._connection() as conn, conn:
+            conn.execute(INSERT_FLOW_STATE,
+                         (flow_id, bytes(data), _to_db_time(expires_at)))
+
+    def get_flow_state(self, flow_id):
+        """Get encoded flow state if it has not expired"""
+        with self._connection() as conn:
+            row = conn.execute(
+                SELECT_FLOW_STATE, (flow_id, _to_db_time(datetime.utcnow()))).fetchone()
+        return row['data'] if row else None
+
+    def update_flow_state(self, flow_id, data):
+        """Replace flow state; returns False if it is missing or expired"""
+        with self._connection() as conn, conn:
+            cursor = conn.execute(UPDATE_FLOW_STATE, (
+                bytes(data), flow_id, _to_db_time(datetime.utcnow())))
+        return cursor.rowcount == 1
+
+    def consume_flow_state(self, flow_id):
+        """Atomically delete and return flow state if it has not expired"""
+        with self._connection() as conn, conn:
+            row = conn.execute(
+                SELECT_FLOW_STATE, (flow_id, _to_db_time(datetime.utcnow()))).fetchone()
+            if not row:
+                return None
+            # Only the caller whose delete removed the row may use the state
+            if conn.execute(DELETE_FLOW_STATE, (flow_id,)).rowcount != 1:
+                return None
+        return row['data']
+
+    def cleanup_expired_flow_states(self):
+        """Remove expired flow state"""
+        with self._connection() as conn, conn:
+            conn.execute(DELETE_EXPIRED_FLOW_STATES,
+                         (_to_db_time(datetime.utcnow()),))
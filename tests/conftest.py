@@ -0,0 +1,63 @@
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from saml2.sigver import SigverError, get_xmlsec_binary
+
+# Modules create their global database and replay cache on import; point
+# them at throwaway files before any test imports them
+_scratch = tempfile.mkdtemp(prefix='saml-passkey-idp-tests-')
+os.environ.setdefault('STORAGE_BACKEND', 'sqlite')
+os.environ.setdefault('SQLITE_PATH', os.path.join(_scratch, 'idp.db'))
+os.environ.setdefault('REPLAY_CACHE_PATH', os.path.join(_scratch, 'replay_cache.bin'))
+os.environ.setdefault('SP_METADATA_URLS', '')
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+
+def write_key_pair(directory, common_name):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256()))
+    with open(os.path.join(directory, 'idp_key.pem'), 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM,
+                                  serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+    with open(os.path.join(directory, 'idp_cert.pem'), 'wb') as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+
+
+@pytest.fixture(scope='session')
+def app_module(tmp_path_factory):
+    try:
+        get_xmlsec_binary(['/usr/bin', '/usr/local/bin'])
+    except SigverError:
+        pytest.skip("xmlsec1 is needed to load the SAML configuration")
+
+    # The SAML config uses paths relative to the working directory
+    workdir = tmp_path_factory.mktemp('idp')
+    os.mkdir(workdir / 'saml_certs')
+    write_key_pair(workdir / 'saml_certs', 'localhost')
+    shutil.copytree(os.path.join(REPO_ROOT, 'saml_attribute_maps'),
+                    workdir / 'saml_attribute_maps')
+    previous = os.getcwd()
+    os.chdir(workdir)
+    try:
+        import app
+        yield app
+    finally:
+        os.chdir(previous)
@@ -0,0 +1,207 @@
+"""Behaviour every storage backend must share.
+
+The MongoDB cases run against MONGODB_URI in a throwaway database and are
+skipped when no server answers.
+"""
+import functools
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from config import Config
+from database import DuplicateUserError, MongoDatabase
+from sqlite_database import SQLiteDatabase
+
+
+@functools.lru_cache(maxsize=None)
+def _mongo_available():
+    client = MongoClient(Config.MONGODB_URI, serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command('ping')
+        return True
+    except PyMongoError:
+        return False
+    finally:
+        client.close()
+
+
+def _mongo_database():
+    if not _mongo_available():
+        pytest.skip(f"No MongoDB server at {Config.MONGODB_URI}")
+    database = MongoDatabase(db_name=f"saml_passkey_idp_test_{uuid.uuid4().hex[:8]}")
+    database.create_indexes()
+    return database
+
+
+@pytest.fixture(params=['mongodb', 'sqlite'])
+def db(request, tmp_path):
+    if request.param == 'mongodb':
+        database = _mongo_database()
+        yield database
+        database.client.drop_database(database.db.name)
+        database.client.close()
+    else:
+        database = SQLiteDatabase(str(tmp_path / 'idp.db'))
+        yield database
+        database.close()
+
+
+def credential(credential_id, sign_count=0):
+    return {
+        'credential_id': credential_id,
+        'public_key': b'public-key-' + credential_id,
+        'sign_count': sign_count,
+        'credential_type': 'public-key',
+        'credential_device_type': 'multi_device',
+        'credential_backed_up': True,
+    }
+
+
+def test_create_and_get_user(db):
+    created = db.create_user('alice@example.com', 'user-1')
+    assert created['passkey_credentials'] == []
+
+    for user in (db.get_user_by_email('alice@example.com'), db.get_user_by_id('user-1')):
+        assert user['email'] == 'alice@example.com'
+        assert user['user_id'] == 'user-1'
+        assert user['passkey_credentials'] == []
+        assert isinstance(user['created_at'], datetime)
+
+    assert db.get_user_by_email('bob@example.com') is None
+    assert db.get_user_by_id('user-2') is None
+
+
+def test_duplicate_email_is_rejected(db):
+    db.create_user('alice@example.com', 'user-1')
+    with pytest.raises(DuplicateUserError):
+        db.create_user('alice@example.com', 'user-2')
+    assert db.get_user_by_id('user-2') is None
+
+
+def test_duplicate_user_id_is_rejected(db):
+    db.create_user('alice@example.com', 'user-1')
+    with pytest.raises(DuplicateUserError):
+        db.create_user('bob@example.com', 'user-1')
+
+
+def test_credentials_round_trip_as_bytes(db):
+    db.create_user('alice@example.com', 'user-1')
+    db.add_passkey_credential('user-1', credential(b'\x00cred-1'))
+    db.add_passkey_credential('user-1', credential(b'\x00cred-2'))
+
+    credentials = db.get_user_credentials('user-1')
+    assert [c['credential_id'] for c in credentials] == [b'\x00cred-1', b'\x00cred-2']
+    assert credentials[0] == credential(b'\x00cred-1')
+    assert db.get_user_credentials('missing') == []
+
+
+def test_lookup_by_credential_id(db):
+    db.create_user('alice@example.com', 'user-1')
+    db.add_passkey_credential('user-1', credential(b'cred-1'))
+
+    user, found = db.get_user_and_credential_by_credential_id(b'cred-1')
+    assert user['user_id'] == 'user-1'
+    assert found['credential_id'] == b'cred-1'
+    assert db.get_user_and_credential_by_credential_id(b'unknown') == (None, None)
+
+
+def test_update_credential_counter(db):
+    db.create_user('alice@example.com', 'user-1')
+    db.add_passkey_credential('user-1', credential(b'cred-1'))
+    db.add_passkey_credential('user-1', credential(b'cred-2'))
+
+    db.update_credential_counter('user-1', b'cred-2', 7)
+    counts = {c['credential_id']: c['sign_count'] for c in db.get_user_credentials('user-1')}
+    assert counts == {b'cred-1': 0, b'cred-2': 7}
+
+
+def test_sessions(db):
+    expires_at = datetime.utcnow() + timedelta(minutes=5)
+    db.create_session('s-1', 'user-1', {'id': 'req-1'}, expires_at)
+
+    stored = db.get_session('s-1')
+    assert stored['user_id'] == 'user-1'
+    assert stored['saml_request'] == {'id': 'req-1'}
+    assert stored['authenticated'] is False
+    assert abs(stored['expires_at'] - expires_at) < timedelta(milliseconds=1)
+
+    db.update_session('s-1')
+    assert db.get_session('s-1')['authenticated'] is True
+    db.delete_session('s-1')
+    assert db.get_session('s-1') is None
+
+
+def test_cleanup_removes_only_expired_sessions(db):
+    now = datetime.utcnow()
+    db.create_session('old', None, None, now - timedelta(seconds=1))
+    db.create_session('new', None, None, now + timedelta(minutes=5))
+    db.cleanup_expired_sessions()
+    assert db.get_session('old') is None
+    assert db.get_session('new') is not None
+
+
+def test_seen_ids_expire(db):
+    now = datetime.utcnow()
+    db.record_seen_id('assertion:live', now + timedelta(minutes=5))
+    db.record_seen_id('assertion:old', now - timedelta(seconds=1))
+    assert db.has_seen_id('assertion:live')
+    assert not db.has_seen_id('assertion:old')
+    assert not db.has_seen_id('assertion:never')
+
+    # Recording the same key again extends it instead of failing
+    db.record_seen_id('assertion:old', now + timedelta(minutes=5))
+    assert db.has_seen_id('assertion:old')
+
+    db.cleanup_expired_replay_ids()
+    assert db.has_seen_id('assertion:live')
+
+
+def test_claim_id_succeeds_once_until_expiry(db):
+    now = datetime.utcnow()
+    assert db.claim_id('challenge:abc', now + timedelta(minutes=5))
+    assert not db.claim_id('challenge:abc', now + timedelta(minutes=5))
+    assert db.has_seen_id('challenge:abc')
+
+    db.claim_id('challenge:old', now - timedelta(seconds=1))
+    assert db.claim_id('challenge:old', now + timedelta(minutes=5))
+
+
+def test_flow_state_is_consumed_once(db):
+    expires_at = datetime.utcnow() + timedelta(minutes=5)
+    db.create_flow_state('flow-1', b'\x01state', expires_at)
+    assert bytes(db.get_flow_state('flow-1')) == b'\x01state'
+
+    assert db.update_flow_state('flow-1', b'\x01updated')
+    assert not db.update_flow_state('flow-2', b'\x01missing')
+
+    assert bytes(db.consume_flow_state('flow-1')) == b'\x01updated'
+    assert db.consume_flow_state('flow-1') is None
+    assert db.get_flow_state('flow-1') is None
+
+
+def test_expired_flow_state_is_invisible(db):
+    db.create_flow_state('flow-1', b'\x01state', datetime.utcnow() - timedelta(seconds=1))
+    assert db.get_flow_state('flow-1') is None
+    assert not db.update_flow_state('flow-1', b'\x01updated')
+    assert db.consume_flow_state('flow-1') is None
+    db.cleanup_expired_flow_states()
+
+
+def stored_flow_ids(db):
+    if isinstance(db, MongoDatabase):
+        return {doc['flow_id'] for doc in db.flow_states.find({}, {'flow_id': 1})}
+    with db._connection() as conn:
+        return {row['flow_id'] for row in conn.execute('SELECT flow_id FROM flow_states')}
+
+
+def test_cleanup_expired_removes_old_records(db):
+    now = datetime.utcnow()
+    db.create_flow_state('old', b'\x01state', now - timedelta(seconds=1))
+    db.create_flow_state('new', b'\x01state', now + timedelta(minutes=5))
+    db.create_session('old', None, None, now - timedelta(seconds=1))
+    db.cleanup_expired()
+    assert stored_flow_ids(db) == {'new'}
+    assert db.get_session('old') is None
@@ -0,0 +1,142 @@
+import threading
+
+import pytest
+from flask import Flask
+from flask.sessions import SecureCookieSessionInterface
+from saml2 import BINDING_HTTP_POST, BINDING_HTTP_REDIRECT
+
+import flow_state
+from config import Config
+from flow_state import (
+    DatabaseFlowStateStore, MemoryFlowStateStore, decode_flow_state, encode_flow_state)
+from sqlite_database import SQLiteDatabase
+
+REQUEST = {
+    'id': 'id-4f6c2a',
+    'binding': BINDING_HTTP_REDIRECT,
+    'destination': 'https://sp.example.org/acs',
+    'issuer': 'https://sp.example.org',
+}
+
+
+def test_round_trip_without_user():
+    assert decode_flow_state(encode_flow_state(REQUEST)) == REQUEST
+
+
+def test_round_trip_with_user_and_non_ascii_fields():
+    state = dict(REQUEST, binding=BINDING_HTTP_POST, issuer='https://sp.example.org/ü',
+                 user_id='user-1', email='zoë@example.com')
+    assert decode_flow_state(encode_flow_state(state)) == state
+
+
+def test_encoding_is_compact():
+    # Version and binding bytes plus a 2-byte length before each field
+    data = encode_flow_state(REQUEST)
+    fields = sum(len(REQUEST[f].encode('utf-8')) for f in ('id', 'destination', 'issuer'))
+    assert len(data) == 2 + 2 * len(flow_state.FIELDS) + fields
+
+
+def test_unknown_version_is_rejected():
+    data = bytearray(encode_flow_state(REQUEST))
+    data[0] = flow_state.FORMAT_VERSION + 1
+    with pytest.raises(ValueError):
+        decode_flow_state(bytes(data))
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(flow_state.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_memory_flow_expires_after_ttl(clock):
+    store = MemoryFlowStateStore(ttl=600)
+    flow_id = store.create(dict(REQUEST))
+    clock[0] += 599
+    assert store.get(flow_id) == REQUEST
+
+    clock[0] += 1
+    assert store.get(flow_id) is None
+    assert not store.update(flow_id, dict(REQUEST, user_id='user-1'))
+    assert store.consume(flow_id) is None
+
+
+def test_memory_store_sweeps_expired_flows(clock):
+    store = MemoryFlowStateStore(ttl=600)
+    expired = [store.create(dict(REQUEST)) for _ in range(10)]
+    clock[0] += 601
+    live = [store.create(dict(REQUEST))
+            for _ in range(store.SWEEP_EVERY - len(expired))]
+
+    assert not set(expired) & set(store.entries)
+    assert set(live) == set(store.entries)
+
+
+def test_memory_flow_is_consumed_by_one_caller():
+    store = MemoryFlowStateStore(ttl=600)
+    flow_id = store.create(dict(REQUEST))
+    barrier = threading.Barrier(16)
+    results = []
+
+    def consume():
+        barrier.wait()
+        results.append(store.consume(flow_id))
+
+    threads = [threading.Thread(target=consume) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results.count(None) == 15
+    assert [r for r in results if r] == [REQUEST]
+
+
+def test_session_cookie_only_carries_the_flow_id():
+    app = Flask(__name__)
+    app.secret_key = Config.SECRET_KEY
+    serializer = SecureCookieSessionInterface().get_signing_serializer(app)
+
+    flow_id = MemoryFlowStateStore(ttl=600).create(dict(REQUEST))
+    server_side = serializer.dumps({'saml_flow': flow_id})
+    in_cookie = serializer.dumps({'saml_session_id': flow_id * 2, 'saml_request': REQUEST})
+    # The README promises about 90 bytes
+    assert len(server_side) <= 100
+    assert len(server_side) < len(in_cookie)
+
+
+@pytest.fixture(params=['memory', 'database'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        yield MemoryFlowStateStore(ttl=600)
+    else:
+        database = SQLiteDatabase(str(tmp_path / 'idp.db'))
+        yield DatabaseFlowStateStore(600, database)
+        database.close()
+
+
+def test_unauthenticated_flow_survives_an_early_consume(store):
+    flow_id = store.create(dict(REQUEST))
+    assert store.consume_authenticated(flow_id) is None
+    assert store.get(flow_id) == REQUEST
+
+    state = dict(REQUEST, user_id='user-1', email='alice@example.com')
+    assert store.update(flow_id, state)
+    assert store.consume_authenticated(flow_id) == state
+    assert store.consume_authenticated(flow_id) is None
+    assert store.get(flow_id) is None
+
+
+def test_early_saml_response_does_not_end_a_server_side_flow(app_module, monkeypatch):
+    store = MemoryFlowStateStore(ttl=600)
+    monkeypatch.setattr(app_module, 'flow_state_store', store)
+    client = app_module.app.test_client()
+    flow_id = store.create(dict(REQUEST))
+    with client.session_transaction() as sess:
+        sess['saml_flow'] = flow_id
+
+    assert client.get('/saml/response').status_code == 400
+    assert store.get(flow_id) == REQUEST
+    with client.session_transaction() as sess:
+        assert sess['saml_flow'] == flow_id
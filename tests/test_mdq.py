@@ -0,0 +1,156 @@
+"""LazySPMetadata against a local MDQ server publishing 10,000 entities"""
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import pytest
+
+import sp_metadata
+from sp_metadata import LazySPMetadata, MDQ_CONTENT_TYPE
+
+from test_sp_metadata import entity_descriptor
+
+ENTITY_COUNT = 10_000
+ENTITY_IDS = [f"https://sp{i}.example.org/shibboleth" for i in range(ENTITY_COUNT)]
+KNOWN = set(ENTITY_IDS)
+PREFIX = '/entities/'
+
+
+class MDQServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), MDQHandler)
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.delay = 0.0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class MDQHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        entity_id = unquote(self.path[len(PREFIX):])
+        with self.server.lock:
+            self.server.requests[entity_id] += 1
+        time.sleep(self.server.delay)
+
+        if not self.path.startswith(PREFIX) or entity_id not in KNOWN:
+            self.send_error(404)
+            return
+        body = entity_descriptor(entity_id).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', MDQ_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = MDQServer()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def mdq(server):
+    server.requests.clear()
+    server.delay = 0.0
+    return server
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(sp_metadata.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def make_resolver(server, **kwargs):
+    return LazySPMetadata([], mdq_url=server.url, timeout=5, **kwargs)
+
+
+def test_concurrent_misses_share_one_fetch(mdq):
+    mdq.delay = 0.2
+    resolver = make_resolver(mdq)
+    entity_id = ENTITY_IDS[42]
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        results = list(pool.map(lambda _: resolver.resolve(entity_id), range(32)))
+
+    assert mdq.requests[entity_id] == 1
+    assert all(result is results[0] for result in results)
+    assert results[0] is not None
+    assert resolver.stats()['misses'] == 1
+
+
+def test_cache_stays_bounded_across_all_entities(mdq):
+    resolver = make_resolver(mdq, max_entries=500)
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        resolved = list(pool.map(resolver.resolve, ENTITY_IDS))
+
+    assert all(entity is not None for entity in resolved)
+    assert sum(mdq.requests.values()) == ENTITY_COUNT
+    stats = resolver.stats()
+    assert stats['entries'] == 500
+    assert len(resolver.expires) == 500
+
+    # The most recently used entities are hits; the oldest were evicted
+    resolver.resolve(ENTITY_IDS[-1])
+    assert mdq.requests[ENTITY_IDS[-1]] == 1
+    resolver.resolve(ENTITY_IDS[0])
+    assert mdq.requests[ENTITY_IDS[0]] == 2
+    assert resolver.stats()['entries'] == 500
+
+
+def test_entries_expire_after_ttl(mdq, clock):
+    resolver = make_resolver(mdq, ttl=60)
+    entity_id = ENTITY_IDS[7]
+
+    resolver.resolve(entity_id)
+    clock[0] += 59
+    resolver.resolve(entity_id)
+    assert mdq.requests[entity_id] == 1
+
+    clock[0] += 2
+    assert resolver.resolve(entity_id) is not None
+    assert mdq.requests[entity_id] == 2
+
+
+def test_unknown_entities_are_cached_negatively(mdq, clock):
+    resolver = make_resolver(mdq, negative_ttl=30)
+    unknown = 'https://unknown.example.org/shibboleth'
+
+    for _ in range(5):
+        assert resolver.resolve(unknown) is None
+    assert mdq.requests[unknown] == 1
+    with pytest.raises(KeyError):
+        resolver[unknown]
+    assert mdq.requests[unknown] == 1
+
+    clock[0] += 31
+    assert resolver.resolve(unknown) is None
+    assert mdq.requests[unknown] == 2
+
+
+def test_expired_entry_is_served_while_the_source_fails(mdq, clock):
+    resolver = make_resolver(mdq, ttl=60, negative_ttl=30)
+    entity_id = ENTITY_IDS[9]
+    entity = resolver.resolve(entity_id)
+
+    clock[0] += 61
+    resolver.mdq_url = 'http://127.0.0.1:9'  # nothing listens on the discard port
+    assert resolver.resolve(entity_id) is entity
@@ -0,0 +1,81 @@
+"""Conditional serving of /saml/metadata"""
+import datetime
+import gzip
+import os
+
+import pytest
+
+from conftest import write_key_pair
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
+
+
+def test_plain_metadata_has_strong_validators(client):
+    response = client.get('/saml/metadata', headers={'Accept-Encoding': 'identity'})
+    assert response.status_code == 200
+    assert b'EntityDescriptor' in response.data
+    assert 'Content-Encoding' not in response.headers
+
+    etag, weak = response.get_etag()
+    assert etag and not weak
+    assert not etag.endswith('-gzip')
+    assert response.last_modified is not None
+    assert 'Accept-Encoding' in response.vary
+    assert response.cache_control.public
+    assert response.cache_control.max_age == 3600
+
+
+def test_gzip_variant_has_its_own_etag(client):
+    plain = client.get('/saml/metadata', headers={'Accept-Encoding': 'identity'})
+    compressed = client.get('/saml/metadata', headers={'Accept-Encoding': 'gzip'})
+    assert compressed.status_code == 200
+    assert compressed.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(compressed.data) == plain.data
+
+    etag, weak = compressed.get_etag()
+    assert not weak
+    assert etag == plain.get_etag()[0] + '-gzip'
+    assert 'Accept-Encoding' in compressed.vary
+
+
+@pytest.mark.parametrize('encoding', ['identity', 'gzip'])
+def test_if_none_match_returns_304(client, encoding):
+    first = client.get('/saml/metadata', headers={'Accept-Encoding': encoding})
+    second = client.get('/saml/metadata', headers={
+        'Accept-Encoding': encoding, 'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 304
+    assert second.data == b''
+    assert second.headers['ETag'] == first.headers['ETag']
+
+
+def test_etag_of_the_other_encoding_does_not_match(client):
+    plain = client.get('/saml/metadata', headers={'Accept-Encoding': 'identity'})
+    response = client.get('/saml/metadata', headers={
+        'Accept-Encoding': 'gzip', 'If-None-Match': plain.headers['ETag']})
+    assert response.status_code == 200
+
+
+def test_if_modified_since_returns_304(client):
+    first = client.get('/saml/metadata', headers={'Accept-Encoding': 'identity'})
+    second = client.get('/saml/metadata', headers={
+        'Accept-Encoding': 'identity', 'If-Modified-Since': first.headers['Last-Modified']})
+    assert second.status_code == 304
+
+
+def test_metadata_is_rebuilt_when_the_certificate_changes(app_module, client):
+    first = client.get('/saml/metadata', headers={'Accept-Encoding': 'identity'})
+
+    write_key_pair('saml_certs', 'rotated.example.org')
+    changed_at = int(datetime.datetime.now(datetime.timezone.utc).timestamp()) + 60
+    os.utime('saml_certs/idp_cert.pem', (changed_at, changed_at))
+    # Skip the interval between key checks
+    app_module.saml_handler.metadata_checked_at = 0.0
+
+    second = client.get('/saml/metadata', headers={
+        'Accept-Encoding': 'identity', 'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 200
+    assert second.headers['ETag'] != first.headers['ETag']
+    assert second.last_modified.timestamp() == changed_at
@@ -0,0 +1,26 @@
+import calendar
+
+import passkey_manager as module
+from passkey_manager import passkey_manager
+
+
+def test_challenge_is_remembered_for_as_long_as_it_verifies(monkeypatch):
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(module.time, 'time', lambda: now[0])
+    challenge = passkey_manager.issue_challenge()
+    claim_until = calendar.timegm(
+        passkey_manager.challenge_expires_at(challenge).timetuple())
+
+    now[0] += passkey_manager.challenge_ttl
+    assert passkey_manager.verify_challenge(challenge)
+    assert claim_until > now[0]
+
+    now[0] += 1
+    assert not passkey_manager.verify_challenge(challenge)
+
+
+def test_tampered_challenge_is_rejected():
+    challenge = bytearray(passkey_manager.issue_challenge())
+    challenge[10] ^= 1
+    assert not passkey_manager.verify_challenge(bytes(challenge))
+    assert not passkey_manager.verify_challenge(b'short')
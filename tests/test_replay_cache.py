@@ -0,0 +1,133 @@
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+from replay_cache import ReplayCache, fcntl
+from sqlite_database import SQLiteDatabase
+
+
+class SlowStore(SQLiteDatabase):
+    """SQLite exact store whose writes take long enough to expose races"""
+
+    def record_seen_id(self, key, expires_at):
+        time.sleep(0.05)
+        super().record_seen_id(key, expires_at)
+
+
+def make_cache(path=None, clock=None, exact_store=None):
+    kwargs = {'clock': clock} if clock else {}
+    return ReplayCache(window=300, expected_rps=50, false_positive_rate=0.001,
+                       path=path, exact_store=exact_store, **kwargs)
+
+
+def test_detects_replay_within_window():
+    cache = make_cache()
+    assert cache.check_and_add('authn_request', 'id-1') is False
+    assert cache.check_and_add('authn_request', 'id-1') is True
+    assert cache.check_and_add('assertion', 'id-1') is False
+
+
+def test_forgets_ids_after_the_ring_rotates():
+    now = [1000.0]
+    cache = make_cache(clock=lambda: now[0])
+    cache.check_and_add('authn_request', 'id-1')
+    now[0] += cache.window + 2 * cache.span
+    assert cache.check_and_add('authn_request', 'id-1') is False
+
+
+@pytest.mark.skipif(fcntl is None, reason="shared filters need POSIX file locks")
+def test_caches_on_the_same_file_share_filters(tmp_path):
+    path = str(tmp_path / 'ring.bin')
+    first = make_cache(path)
+    second = make_cache(path)
+    assert first.check_and_add('authn_request', 'id-1') is False
+    assert second.check_and_add('authn_request', 'id-1') is True
+
+
+def _check_in_child(path, results):
+    results.put(make_cache(path).check_and_add('authn_request', 'shared-id'))
+
+
+@pytest.mark.skipif(fcntl is None, reason="shared filters need POSIX file locks")
+def test_only_one_process_accepts_an_id(tmp_path):
+    path = str(tmp_path / 'ring.bin')
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    workers = [context.Process(target=_check_in_child, args=(path, results))
+               for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    outcomes = [results.get(timeout=5) for _ in workers]
+    assert outcomes.count(False) == 1
+
+
+def test_layout_change_reinitializes_the_file(tmp_path):
+    path = str(tmp_path / 'ring.bin')
+    make_cache(path).check_and_add('authn_request', 'id-1')
+    resized = ReplayCache(window=300, expected_rps=500, false_positive_rate=0.001, path=path)
+    assert resized.check_and_add('authn_request', 'id-1') is False
+
+
+@pytest.mark.skipif(fcntl is None, reason="shared filters need POSIX file locks")
+def test_concurrent_copies_with_an_exact_store_are_rejected(tmp_path):
+    store = SlowStore(str(tmp_path / 'idp.db'))
+    path = str(tmp_path / 'ring.bin')
+    # Separate caches on one file, as in separate workers
+    caches = [make_cache(path, exact_store=store) for _ in range(4)]
+    barrier = threading.Barrier(len(caches))
+    outcomes = []
+
+    def check(cache):
+        barrier.wait()
+        outcomes.append(cache.check_and_add('authn_request', 'shared-id'))
+
+    threads = [threading.Thread(target=check, args=(cache,)) for cache in caches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(outcomes) == [False, True, True, True]
+    assert sum(cache.stats()['false_positives'] for cache in caches) == 0
+    assert store.has_seen_id('authn_request:shared-id')
+
+
+def _check_with_store_in_child(path, db_path, results):
+    cache = make_cache(path, exact_store=SlowStore(db_path))
+    results.put(cache.check_and_add('authn_request', 'shared-id'))
+
+
+@pytest.mark.skipif(fcntl is None, reason="shared filters need POSIX file locks")
+def test_only_one_process_accepts_an_id_with_an_exact_store(tmp_path):
+    path = str(tmp_path / 'ring.bin')
+    db_path = str(tmp_path / 'idp.db')
+    SQLiteDatabase(db_path).close()
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    workers = [context.Process(target=_check_with_store_in_child,
+                               args=(path, db_path, results))
+               for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    outcomes = [results.get(timeout=5) for _ in workers]
+    assert outcomes.count(False) == 1
+
+
+def test_exact_store_miss_after_a_possible_hit_is_a_false_positive(tmp_path):
+    store = SQLiteDatabase(str(tmp_path / 'idp.db'))
+    cache = make_cache(exact_store=store)
+    assert cache.check_and_add('authn_request', 'id-1') is False
+    # Simulate a filter collision: the bits are set but the store has no record
+    with store._connection() as conn, conn:
+        conn.execute('DELETE FROM replay_ids')
+    assert cache.check_and_add('authn_request', 'id-1') is False
+    assert cache.stats()['false_positives'] == 1
+    assert cache.check_and_add('authn_request', 'id-1') is True
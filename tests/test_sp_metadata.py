@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from sp_metadata import LazySPMetadata, SPMetadataSource
+
+SP_URL = 'http://sp.example.org/saml/metadata'
+
+
+def entity_descriptor(entity_id):
+    """Minimal SP metadata for one entity"""
+    return f"""<?xml version="1.0"?>
+<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" entityID="{entity_id}">
+  <md:SPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+    <md:AssertionConsumerService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+        Location="{entity_id}/acs" index="0"/>
+  </md:SPSSODescriptor>
+</md:EntityDescriptor>"""
+
+
+def make_source(tmp_path, url=SP_URL):
+    store = SimpleNamespace(attrc=[], metadata={})
+    return SPMetadataSource(store, [url], str(tmp_path), 3600, 5)
+
+
+def write_snapshot(source, xml=None, validators=None):
+    path = source._snapshot_path(SP_URL)
+    if xml is not None:
+        with open(path, 'w') as f:
+            f.write(xml)
+    if validators is not None:
+        with open(path + '.json', 'w') as f:
+            json.dump(validators, f)
+
+
+def test_snapshot_loads_with_its_validators(tmp_path):
+    source = make_source(tmp_path)
+    write_snapshot(source, entity_descriptor('https://sp.example.org'), {'etag': '"v1"'})
+    source.load_snapshots()
+    assert 'https://sp.example.org' in source.store.metadata[SP_URL].entity
+    assert source.validators[SP_URL] == {'etag': '"v1"'}
+
+
+def test_snapshot_without_validators_still_loads(tmp_path):
+    source = make_source(tmp_path)
+    write_snapshot(source, entity_descriptor('https://sp.example.org'))
+    source.load_snapshots()
+    assert SP_URL in source.store.metadata
+    assert source.validators[SP_URL] == {}
+
+
+def test_corrupt_snapshot_does_not_keep_its_validators(tmp_path):
+    source = make_source(tmp_path)
+    write_snapshot(source, '<md:EntityDescriptor', {'etag': '"v1"'})
+    source.load_snapshots()
+    assert SP_URL not in source.store.metadata
+    # The first refresh must be unconditional, not answered with a 304
+    assert SP_URL not in source.validators
+
+
+def test_missing_snapshot_is_skipped(tmp_path):
+    source = make_source(tmp_path)
+    source.load_snapshots()
+    assert source.store.metadata == {}
+    assert not os.listdir(tmp_path)
+
+
+def write_entity_file(directory, entity_id):
+    name = hashlib.sha1(entity_id.encode('utf-8')).hexdigest()
+    with open(os.path.join(directory, f"{name}.xml"), 'w') as f:
+        f.write(entity_descriptor(entity_id))
+
+
+def test_unsigned_entity_is_rejected_when_a_cert_is_configured(tmp_path):
+    write_entity_file(tmp_path, 'https://sp.example.org')
+    resolver = LazySPMetadata([], directory=str(tmp_path), cert=str(tmp_path / 'mdq.pem'))
+    assert resolver.resolve('https://sp.example.org') is None
+
+
+def test_unsigned_entity_is_accepted_without_a_cert(tmp_path):
+    write_entity_file(tmp_path, 'https://sp.example.org')
+    resolver = LazySPMetadata([], directory=str(tmp_path))
+    assert resolver.resolve('https://sp.example.org') is not None
+
+
+class MetadataServer(ThreadingHTTPServer):
+    """Serves one metadata document and honours conditional requests"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), MetadataHandler)
+        self.requests = []
+        self.publish(entity_descriptor('https://sp.example.org'), '"v1"')
+
+    def publish(self, body, etag, last_modified='Mon, 05 Oct 2026 10:00:00 GMT'):
+        self.body = body.encode('utf-8')
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/metadata"
+
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.send_header('ETag', server.etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/samlmetadata+xml')
+        self.send_header('Content-Length', str(len(server.body)))
+        self.send_header('ETag', server.etag)
+        self.send_header('Last-Modified', server.last_modified)
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def sp_server():
+    httpd = MetadataServer()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read_snapshot(source, url):
+    path = source._snapshot_path(url)
+    with open(path) as f:
+        xml = f.read()
+    with open(path + '.json') as f:
+        return xml, json.load(f)
+
+
+def test_refresh_installs_and_snapshots_new_metadata(tmp_path, sp_server):
+    source = make_source(tmp_path, sp_server.url)
+    assert source.refresh(sp_server.url) is True
+
+    assert 'If-None-Match' not in sp_server.requests[0]
+    assert 'https://sp.example.org' in source.store.metadata[sp_server.url].entity
+    xml, validators = read_snapshot(source, sp_server.url)
+    assert xml == sp_server.body.decode('utf-8')
+    assert validators == {'etag': '"v1"', 'last_modified': sp_server.last_modified}
+
+
+def test_refresh_sends_validators_and_keeps_metadata_on_304(tmp_path, sp_server):
+    source = make_source(tmp_path, sp_server.url)
+    source.refresh(sp_server.url)
+    installed = source.store.metadata[sp_server.url]
+
+    assert source.refresh(sp_server.url) is False
+    conditional = sp_server.requests[-1]
+    assert conditional['If-None-Match'] == '"v1"'
+    assert conditional['If-Modified-Since'] == sp_server.last_modified
+    assert source.store.metadata[sp_server.url] is installed
+
+
+def test_refresh_replaces_metadata_and_snapshot_on_change(tmp_path, sp_server):
+    source = make_source(tmp_path, sp_server.url)
+    source.refresh(sp_server.url)
+
+    sp_server.publish(entity_descriptor('https://sp2.example.org'), '"v2"',
+                      'Tue, 06 Oct 2026 10:00:00 GMT')
+    assert source.refresh(sp_server.url) is True
+
+    entities = source.store.metadata[sp_server.url].entity
+    assert list(entities) == ['https://sp2.example.org']
+    xml, validators = read_snapshot(source, sp_server.url)
+    assert 'https://sp2.example.org' in xml
+    assert validators == {'etag': '"v2"', 'last_modified': 'Tue, 06 Oct 2026 10:00:00 GMT'}
+    assert source.validators[sp_server.url] == validators
+
+
+@pytest.mark.parametrize('body', [
+    '<md:EntityDescriptor',
+    '<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"/>',
+])
+def test_unusable_response_keeps_live_metadata(tmp_path, sp_server, body):
+    source = make_source(tmp_path, sp_server.url)
+    source.refresh(sp_server.url)
+    installed = source.store.metadata[sp_server.url]
+    snapshot = read_snapshot(source, sp_server.url)
+
+    sp_server.publish(body, '"broken"')
+    assert source.refresh(sp_server.url) is False
+
+    assert source.store.metadata[sp_server.url] is installed
+    assert source.validators[sp_server.url]['etag'] == '"v1"'
+    assert read_snapshot(source, sp_server.url) == snapshot